@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import math
+
+# 分位点スケッチの相対誤差
+SKETCH_ALPHA = 0.02
+# これ未満の値は0として数える（秒）
+SKETCH_MIN_VALUE = 1e-3
+
+
+# ==== 分位点スケッチ（対数バケットのヒストグラム。DDSketch と同じ考え方） ====
+# 値を相対誤差 alpha の幅のバケットに数えるだけなので、件数が増えても大きさはほぼ一定。
+# 返す分位点の相対誤差は alpha 以内。
+class QuantileSketch:
+    def __init__(self, alpha=SKETCH_ALPHA):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = {}      # {バケット番号: 件数}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        value = max(0.0, value)
+        if value < SKETCH_MIN_VALUE:
+            self.zeros += 1
+        else:
+            index = math.ceil(math.log(value) / self._log_gamma)
+            self.bins[index] = self.bins.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if rank < seen:
+                return min(self.max, 2 * self.gamma ** index / (self.gamma + 1))
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 3) if self.count else None,
+            "p50": _round(self.quantile(0.5)),
+            "p90": _round(self.quantile(0.9)),
+            "p99": _round(self.quantile(0.99)),
+            "max": round(self.max, 3),
+        }
+
+    # ---- 保存形式: バケットは [番号, 件数] の組 ----
+    def to_dict(self):
+        return {"alpha": self.alpha, "zeros": self.zeros, "count": self.count, "sum": self.total, "max": self.max,
+                "bins": sorted([index, n] for index, n in self.bins.items())}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data.get("alpha", SKETCH_ALPHA))
+        sketch.zeros = data.get("zeros", 0)
+        sketch.count = data.get("count", 0)
+        sketch.total = data.get("sum", 0.0)
+        sketch.max = data.get("max", 0.0)
+        sketch.bins = {index: n for index, n in data.get("bins", [])}
+        return sketch
+
+
+def _round(value):
+    return round(value, 3) if value is not None else None
+
+
+# プレイヤーがいる章（クリア済みは "cleared"）
+def chapter_of(state):
+    return "cleared" if state.get("game_cleared", False) else str(state.get("current_q", 0))
+
+
+# ==== 集計（状態の変更を適用するたびに数える。全件を読み直さない） ====
+# apply_mutation から、変更を適用する直前の値と一緒に呼ばれる。
+# 状態と一緒にスナップショットに保存され、ジャーナルの再生でも同じ値になる。
+# カウンターは {名前: {キー: 件数}}。キーは問題番号などの文字列。
+class Analytics:
+    def __init__(self):
+        self.counters = {}
+        self.judge_wait = QuantileSketch()   # 画像の回答を受け取ってから判定されるまで（秒、手動の判定のみ）
+
+    def _inc(self, name, key, n=1):
+        counter = self.counters.setdefault(name, {})
+        counter[str(key)] = counter.get(str(key), 0) + n
+
+    def get(self, name, key):
+        return self.counters.get(name, {}).get(str(key), 0)
+
+    # ---- 状態の変化 ----
+    def player_changed(self, before, after):
+        if before is None:
+            self._inc("players", "started")
+            self._inc("reached", after.get("current_q", 0))
+        else:
+            before_q, after_q = before.get("current_q", 0), after.get("current_q", 0)
+            if after_q == before_q + 1:
+                self._inc("solved", before_q)
+            if after_q > before_q:
+                self._inc("reached", after_q)
+            if not before.get("game_cleared", False) and after.get("game_cleared", False):
+                self._inc("solved", before_q)
+                self._inc("players", "cleared")
+            self._inc("chapter", chapter_of(before), -1)
+        if after.get("another_count", 0) > (before or {}).get("another_count", 0):
+            self._inc("replays", after["another_count"])
+        self._inc("chapter", chapter_of(after))
+
+    # answer（テキストで答えた・画像を送った）/ hint（ヒントのキーワードを送った）
+    def record(self, name, qnum):
+        self._inc({"answer": "attempts", "hint": "hints"}.get(name, name), qnum)
+
+    def answer_judged(self, pending, entry):
+        self._inc("verdicts", f"{entry['qnum']}/{entry['result']}")
+        if entry.get("auto_from"):
+            self._inc("judges", "auto")
+            return
+        self._inc("judges", "manual")
+        if pending and "received_at" in pending and entry.get("judged_at"):
+            self.judge_wait.add(entry["judged_at"] - pending["received_at"])
+
+    # ---- 以前のスナップショットには集計がないので、プレイヤーの状態から作れる分だけ作る（1回だけ） ----
+    def seed(self, user_states):
+        for user_id in user_states:
+            state = user_states[user_id]
+            self._inc("players", "started")
+            for qnum in range(state.get("current_q", 0) + 1):
+                self._inc("reached", qnum)
+            if state.get("game_cleared", False):
+                self._inc("players", "cleared")
+            for count in range(1, state.get("another_count", 0) + 1):
+                self._inc("replays", count)
+            self._inc("chapter", chapter_of(state))
+
+    # ---- /stats 向けのまとめ ----
+    def summary(self, chapters):
+        rows = []
+        for qnum in range(chapters):
+            attempts, solved = self.get("attempts", qnum), self.get("solved", qnum)
+            rows.append({
+                "qnum": qnum,
+                "players": self.get("chapter", qnum),
+                "reached": self.get("reached", qnum),
+                "attempts": attempts,
+                "solved": solved,
+                "solve_rate": round(solved / attempts, 3) if attempts else None,
+                "hints": self.get("hints", qnum),
+            })
+        verdicts = {}
+        for key, n in self.counters.get("verdicts", {}).items():
+            qnum, result = key.split("/", 1)
+            verdicts.setdefault(qnum, {})[result] = n
+        return {
+            "players": {
+                "started": self.get("players", "started"),
+                "cleared": self.get("players", "cleared"),
+                "by_chapter": {k: n for k, n in self.counters.get("chapter", {}).items() if n},
+            },
+            "chapters": rows,
+            "verdicts": verdicts,
+            "endings": {result: verdicts.get(str(chapters - 1), {}).get(result, 0) for result in ("good_end", "bad_end")},
+            "replays": dict(self.counters.get("replays", {})),
+            "judging": {
+                "manual": self.get("judges", "manual"),
+                "auto": self.get("judges", "auto"),
+                "wait_seconds": self.judge_wait.summary(),
+            },
+        }
+
+    # ---- 保存・読み込み ----
+    def to_dict(self):
+        return {"counters": {name: dict(counter) for name, counter in self.counters.items()},
+                "judge_wait": self.judge_wait.to_dict()}
+
+    def reset(self, data):
+        self.counters = {name: dict(counter) for name, counter in data.get("counters", {}).items()}
+        self.judge_wait = QuantileSketch.from_dict(data.get("judge_wait", {}))
@@ -3,16 +3,88 @@ import os
 import time
 import uuid
 import json
-from flask import Flask, request, render_template, make_response
-from linebot import LineBotApi, WebhookHandler
+import socket
+import atexit
+import signal
+import threading
+from contextlib import contextmanager
+from flask import Flask, request, render_template, make_response, jsonify, Response, stream_with_context, url_for
+from linebot import WebhookHandler
 from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage, ImageSendMessage, ImageMessage
 import boto3
+from botocore.config import Config
 from botocore.exceptions import BotoCoreError, ClientError
+from state_store import StateStore, S3Backend, LocalDirBackend, SQLiteBackend, SnapshotCache, STATE_REFRESH_INTERVAL
+from delivery import DeliveryScheduler, pack_steps
+from image_ingest import ImageIngestor, ImageTooLargeError, stream_to_s3, spool, upload_thumbnail, THUMB_PREFIX
+from image_derive import load_manifest, build_static, IMMUTABLE_CACHE_CONTROL
+from judge_feed import JudgeFeed
+from pending_queue import CLAIM_LEASE_SECONDS
+from image_hash import ImageHashIndex, dhash, format_hash, IMAGE_MATCH_MODE
+from keyed_pool import KeyedWorkerPool
+from line_client import LineClient
+from lazy_client import LazyClient
+from metrics import registry, timed, log_event, anonymize, instrument_boto3
+
+# ==== 起動時間の計測 ====
+# 起動した時刻（gunicorn では gunicorn.conf.py が親プロセスの起動時刻を入れる）から
+# 状態が最新になるまで・このプロセスが最初のリクエストを受けるまでの秒数
+startup = {
+    "started_at": float(os.environ.get("APP_STARTED_AT") or time.time()),
+    "state_source": None,          # "cache"（ローカルキャッシュ）か "backend"
+    "state_ready_seconds": None,
+    "first_request_seconds": None,
+}
 
 # Flaskアプリケーションの設定
 app = Flask(__name__, static_url_path='/static', static_folder='static')
 
+# ==== 派生画像（プレビュー・縮小画像） ====
+# ビルド時に python image_derive.py で static/derived/ に作っておく。
+# なければ起動後に裏で作り、できるまでは元画像を使う（start_derived_images）
+STATIC_BASE_URL = "https://nazotoki-bot-4-7-9hls.onrender.com/static/"
+derived_images = load_manifest(app.static_folder)
+
+def build_derived_images():
+    try:
+        derived_images.update(build_static(app.static_folder))
+    except Exception as e:
+        print(f"Failed to build derived images: {str(e)}")
+
+derived_pid = None
+
+# プロセスごとに1回（start_state_catch_up から）。preload の親プロセスで作ってもワーカーには届かないので、
+# ワーカーで一覧を読み直し、それでもなければ裏で作る
+def start_derived_images():
+    global derived_pid
+    if derived_pid == os.getpid():
+        return
+    derived_pid = os.getpid()
+    if not derived_images:
+        derived_images.update(load_manifest(app.static_folder))
+    if not derived_images:
+        threading.Thread(target=build_derived_images, name="derive-static", daemon=True).start()
+
+def derived_path(filename, kind):
+    return derived_images.get(filename, {}).get(kind, filename)
+
+# LINEに送る static/ の画像URLを派生画像のURLに置き換える（それ以外のURLはそのまま）
+def derived_url(url, kind):
+    if url.startswith(STATIC_BASE_URL):
+        return STATIC_BASE_URL + derived_path(url[len(STATIC_BASE_URL):], kind)
+    return url
+
+@app.template_global()
+def derived_static(filename, kind="thumb"):
+    return url_for('static', filename=derived_path(filename, kind))
+
+@app.after_request
+def cache_derived_images(response):
+    if request.path.startswith(app.static_url_path + "/derived/") and response.status_code == 200:
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+    return response
+
 # ==== LINE Bot API設定 ====
 LINE_CHANNEL_ACCESS_TOKEN = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")
 LINE_CHANNEL_SECRET = os.environ.get("LINE_CHANNEL_SECRET")
@@ -20,6 +92,7 @@ AWS_ACCESS_KEY_ID = os.environ.get("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY")
 AWS_S3_BUCKET_NAME = os.environ.get("AWS_S3_BUCKET_NAME")
 AWS_S3_REGION = os.environ.get("AWS_S3_REGION", "us-east-1")
+AWS_S3_ENDPOINT_URL = os.environ.get("AWS_S3_ENDPOINT_URL")  # S3互換サーバーを使うとき（ベンチマークなど）
 
 missing_env_vars = []
 if not LINE_CHANNEL_ACCESS_TOKEN:
@@ -35,74 +108,211 @@ if not AWS_S3_BUCKET_NAME:
 if missing_env_vars:
     raise ValueError(f"Missing required environment variables: {', '.join(missing_env_vars)}")
 
-try:
-    line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
-except LineBotApiError as e:
-    raise ValueError(f"Invalid LINE_CHANNEL_ACCESS_TOKEN: {str(e)}")
+def create_line_client():
+    try:
+        # 接続の使い回し・流量制限・429/5xxの再試行は LineClient が行う
+        return LineClient(LINE_CHANNEL_ACCESS_TOKEN)
+    except LineBotApiError as e:
+        raise ValueError(f"Invalid LINE_CHANNEL_ACCESS_TOKEN: {str(e)}")
+
+# クライアントは最初に使うときに作る（プロセスごと）
+line_bot_api = LazyClient(create_line_client)
 
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
 # ==== AWS S3設定 ====
-s3_client = boto3.client(
-    "s3",
-    aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    region_name=AWS_S3_REGION
-)
-
-# ==== S3状態保存キー ====
-STATE_FILE_KEY = "app_state.json"
-
-# ==== 状態変数（初期化） ====
-user_states = {}  # {user_id: {"current_q": int, "answers": [list of answers], "game_cleared": bool, "another_count": int}}
-pending_judges = []  # [{"user_id": str, "qnum": int, "img_url": str, "token": str}]
-judged_history = []  # [{"user_id": str, "qnum": int, "img_url": str, "result": str, "token": str}]
-used_tokens = set()  # 使用済みトークンを追跡
-
-# ==== S3から状態をロード ====
-def load_state_from_s3():
-    global user_states, pending_judges, judged_history, used_tokens
+S3_REQUEST_SECONDS = registry.histogram("nazotoki_s3_request_seconds", "S3 API call latency by operation and status")
+
+def create_s3_client():
+    client = boto3.client(
+        "s3",
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        region_name=AWS_S3_REGION,
+        endpoint_url=AWS_S3_ENDPOINT_URL,
+        config=Config(s3={"addressing_style": "path"}) if AWS_S3_ENDPOINT_URL else None
+    )
+    instrument_boto3(client, S3_REQUEST_SECONDS)
+    return client
+
+s3_client = LazyClient(create_s3_client)
+
+# ==== 計測（/metrics で Prometheus 形式に出す） ====
+WEBHOOK_EVENTS = registry.counter("nazotoki_webhook_events_total", "Webhook events received by type")
+WEBHOOK_REJECTED = registry.counter("nazotoki_webhook_rejected_total", "Webhook requests rejected by reason")
+ANSWERS = registry.counter("nazotoki_answers_total", "Answers by question and outcome")
+HINT_REQUESTS = registry.counter("nazotoki_hint_requests_total", "Hint requests by question")
+VERDICTS = registry.counter("nazotoki_verdicts_total", "Judge verdicts by question and result")
+
+def s3_object_url(key):
+    if AWS_S3_ENDPOINT_URL:
+        return f"{AWS_S3_ENDPOINT_URL.rstrip('/')}/{AWS_S3_BUCKET_NAME}/{key}"
+    return f"https://{AWS_S3_BUCKET_NAME}.s3.{AWS_S3_REGION}.amazonaws.com/{key}"
+
+# ==== 状態ストア（ユーザー単位の変更を追記型ジャーナルに記録） ====
+# 複数ワーカー・複数ノードで共有できる（条件付き書き込みで競合を検出）
+# STATE_BACKEND=local のときはローカルディレクトリ、sqlite のときはSQLiteファイルに保存する（テスト・1台運用向け）
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "s3")
+STATE_LOCAL_DIR = os.environ.get("STATE_LOCAL_DIR", "state_data")
+STATE_SQLITE_PATH = os.environ.get("STATE_SQLITE_PATH", "state.sqlite3")
+# S3の状態を手元に残しておくファイル（スナップショットと同じバイナリ形式。空ならキャッシュしない）。local / sqlite はもともと手元にあるので使わない
+STATE_CACHE_PATH = os.environ.get("STATE_CACHE_PATH", "state_cache.bin")
+state_cache = None
+if STATE_BACKEND == "local":
+    state_backend = LocalDirBackend(STATE_LOCAL_DIR)
+elif STATE_BACKEND == "sqlite":
+    state_backend = SQLiteBackend(STATE_SQLITE_PATH)
+else:
+    state_backend = S3Backend(s3_client, AWS_S3_BUCKET_NAME)
+    if STATE_CACHE_PATH:
+        state_cache = SnapshotCache(STATE_CACHE_PATH, s3_object_url(""))
+state_store = StateStore(state_backend, cache=state_cache)
+
+# ==== 状態変数（ストアのコンテナを参照） ====
+user_states = state_store.state["user_states"]  # PlayerTable: user_id -> {"current_q": int, "game_cleared": bool, "another_count": int}
+pending_judges = state_store.state["pending_judges"]  # PendingQueue: token -> {"user_id": str, "qnum": int, "img_url": str, "thumb_url": str, "token": str}
+judged_history = state_store.state["judged_history"]  # HistoryArchive: [{"user_id": str, "qnum": int, "img_url": str, "result": str, "token": str}]
+used_tokens = state_store.state["used_tokens"]  # 使用済みトークンを追跡（ReplayGuard: 期限付き・件数上限あり）
+seen_events = state_store.state["seen_events"]  # 処理済みのwebhookEventId（ReplayGuard）
+analytics = state_store.state["analytics"]  # 章ごとの人数・正解率などの集計（Analytics。変更の適用時に更新される）
+
+# ==== ストアから状態をロード（スナップショット + ジャーナル再生） ====
+def load_state():
     try:
-        response = s3_client.get_object(Bucket=AWS_S3_BUCKET_NAME, Key=STATE_FILE_KEY)
-        state_data = json.loads(response['Body'].read().decode('utf-8'))
-        user_states = state_data.get("user_states", {})
-        pending_judges = state_data.get("pending_judges", [])
-        judged_history = state_data.get("judged_history", [])
-        used_tokens = set(state_data.get("used_tokens", []))
-        print("State loaded from S3 successfully.")
+        state_store.load()
     except ClientError as e:
-        if e.response['Error']['Code'] == 'NoSuchKey':
-            print("No state file found in S3. Initializing empty state.")
-        else:
-            print(f"Error loading state from S3: {str(e)}")
+        print(f"Error loading state from S3: {str(e)}")
     except Exception as e:
         print(f"Unexpected error loading state: {str(e)}")
 
-# ==== S3に状態を保存 ====
-def save_state_to_s3():
-    state_data = {
-        "user_states": user_states,
-        "pending_judges": pending_judges,
-        "judged_history": judged_history,
-        "used_tokens": list(used_tokens)
-    }
+# ==== 変更分だけを保存 ====
+def user_mutation(user_id, state):
+    return {"op": "user", "user_id": user_id, "state": state}
+
+def event_mutation(event_id):
+    return {"op": "event", "id": event_id, "ts": time.time()}
+
+# 状態は変えずに集計だけを数える（name: "answer" か "hint"）
+def stat_mutation(name, qnum):
+    return {"op": "stat", "name": name, "qnum": qnum}
+
+# 処理中のwebhookイベント（ワーカースレッドごと）
+event_context = threading.local()
+
+# build() は現在の状態から変更のリストを作って返す（状態は直接書き換えない）。
+# 他のワーカーと競合したら最新を読み込んで build() をやり直す。
+# webhookイベントの処理中なら、最初の保存にイベントIDを「処理済み」として同時に書き込む。
+# 書き込みは少し遅らせて他の変更とまとめる。判定のように確定を待つ必要があるときは sync=True。
+def transact(build, sync=False):
+    event_id = getattr(event_context, "event_id", None)
+    if event_id:
+        build_changes = build
+
+        def build():
+            # 同じイベントが別の配信ですでに処理されていれば何もしない
+            if event_id in seen_events:
+                return None
+            mutations = build_changes()
+            return mutations + [event_mutation(event_id)] if mutations else mutations
     try:
-        s3_client.put_object(
-            Bucket=AWS_S3_BUCKET_NAME,
-            Key=STATE_FILE_KEY,
-            Body=json.dumps(state_data, ensure_ascii=False).encode('utf-8'),
-            ContentType='application/json'
-        )
-        print("State saved to S3 successfully.")
+        result = state_store.transact(build, sync=sync)
     except ClientError as e:
         print(f"S3 error saving state: {str(e)} - Code: {e.response.get('Error', {}).get('Code', 'N/A')}")
         raise
     except Exception as e:
-        print(f"Unexpected error saving state to S3: {str(e)}")
+        print(f"Unexpected error saving state: {str(e)}")
         raise
+    if result and event_id:
+        event_context.event_id = None
+    return result
+
+def save_mutations(mutations):
+    return transact(lambda: mutations)
+
+# 集計の保存に失敗しても返信は止めない
+def record_stat(name, qnum):
+    try:
+        transact(lambda: [stat_mutation(name, qnum)])
+    except Exception as e:
+        print(f"Failed to record {name} for question {qnum}: {str(e)}")
+
+# 読み取り専用の処理の前に、他のワーカーの変更を取り込む。
+# プレイヤーの状態で返事を決めるとき（webhook）は max_age=0 で最新まで取り込む。
+# 前のメッセージを別のワーカーが処理していると、進んだはずのプレイヤーを古い問題のまま扱ってしまうため
+def refresh_state(max_age=STATE_REFRESH_INTERVAL):
+    try:
+        state_store.refresh(max_age=max_age)
+    except Exception as e:
+        print(f"Failed to refresh state: {str(e)}")
+
+# 終了時に配信を止めて残りを他のプロセスに任せ、まだ書いていない変更を書き出し、次の起動のためにキャッシュを残す
+def flush_state():
+    try:
+        delivery_scheduler.stop()
+    except Exception as e:
+        print(f"Failed to stop delivery on shutdown: {str(e)}")
+    # 担当中のユーザーは期限を待たずに他のワーカーへ渡す
+    for user_id in list(held_users):
+        release_user(user_id)
+    try:
+        state_store.flush()
+        state_store.save_cache()
+    except Exception as e:
+        print(f"Failed to flush state on shutdown: {str(e)}")
+
+atexit.register(flush_state)
+
+# gunicorn はワーカー停止に SIGTERM を使うので、既存のハンドラの前に書き出す
+def install_sigterm_flush():
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def on_sigterm(signum, frame):
+        flush_state()
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            raise SystemExit(0)
+    try:
+        signal.signal(signal.SIGTERM, on_sigterm)
+    except ValueError:
+        # メインスレッド以外で読み込まれたときは atexit だけに任せる
+        pass
+
+install_sigterm_flush()
+
+# ==== 判定画面向けの差分フィード ====
+judge_feed = JudgeFeed()
+state_store.subscribe(judge_feed.observe)
+
+# ==== 判定済み画像との照合（似た回答に同じ判定を提案・自動判定） ====
+image_index = ImageHashIndex(judged_history)
+if IMAGE_MATCH_MODE != "off":
+    state_store.subscribe(image_index.observe)
+
+# ==== 起動時の状態の読み込み ====
+# ローカルキャッシュがあれば S3 を待たずにそれで起動し、最新との差分は裏で取り込む（start_state_catch_up）。
+# なければ今まで通り S3 から読み込んでから起動する。
+# gunicorn の preload では親プロセスで1回だけ読み込み、各ワーカーは fork 後に差分だけを取り込む。
+STATE_READY_TIMEOUT = float(os.environ.get("STATE_READY_TIMEOUT", "30"))
+state_ready = threading.Event()
+
+def mark_state_ready():
+    if state_ready.is_set():
+        return
+    startup["state_ready_seconds"] = round(time.time() - startup["started_at"], 3)
+    state_ready.set()
+    log_event("state_ready", always=True, source=startup["state_source"], seconds=startup["state_ready_seconds"])
+
+def hydrate_state():
+    if state_store.load_cached():
+        startup["state_source"] = "cache"
+        return
+    load_state()
+    startup["state_source"] = "backend"
+    mark_state_ready()
 
 # アプリロード時に状態をロード（Render.com対応）
-load_state_from_s3()
+hydrate_state()
 
 # ==== 謎の問題データ ====
 questions = [
@@ -233,101 +443,123 @@ questions = [
     }
 ]
 
-# ==== 関数: 問題またはストーリーを送信 ====
-def send_content(user_id, content_type, content_data):
-    try:
-        if content_type == "question":
-            q = content_data
-            for story_msg in q["story_messages"]:
-                if "text" in story_msg:
-                    line_bot_api.push_message(user_id, TextSendMessage(text=story_msg["text"]))
-                elif "image_url" in story_msg:
-                    line_bot_api.push_message(
-                        user_id,
-                        ImageSendMessage(
-                            original_content_url=story_msg["image_url"],
-                            preview_image_url=story_msg["image_url"]
-                        )
-                    )
-                time.sleep(story_msg["delay_seconds"] + 1)
-            line_bot_api.push_message(
-                user_id,
-                ImageSendMessage(original_content_url=q["image_url"]["url"], preview_image_url=q["image_url"]["url"])
-            )
-            time.sleep(q["image_url"]["delay_seconds"] + 1)
-            if "current_q" in user_states[user_id] and user_states[user_id]["current_q"] in [1, 4]:
-                message = "答えとなるものの写真を送ってください。"
-                if q["hint_keyword"]:
-                    message += f" ヒントが欲しい場合には{q['hint_keyword']}と送ってください。"
-                line_bot_api.push_message(user_id, TextSendMessage(text=message))
-            else:
-                message = "答えとなるテキストを送ってください。"
-                if q["hint_keyword"]:
-                    message += f" ヒントが欲しい場合には{q['hint_keyword']}と送ってください。"
-                line_bot_api.push_message(user_id, TextSendMessage(text=message))
-        elif content_type == "end_story":
-            for story_msg in content_data:
-                if "text" in story_msg:
-                    line_bot_api.push_message(user_id, TextSendMessage(text=story_msg["text"]))
-                elif "image_url" in story_msg:
-                    line_bot_api.push_message(
-                        user_id,
-                        ImageSendMessage(
-                            original_content_url=story_msg["image_url"],
-                            preview_image_url=story_msg["image_url"]
-                        )
-                    )
-                time.sleep(story_msg["delay_seconds"] + 1)
-            time.sleep(2)
-            line_bot_api.push_message(
-                user_id,
-                TextSendMessage(text='''ゲームクリア！お疲れ様でした！
-第5問には2つの解答が用意されています。
-もう一方の解答もぜひ考えて、試してみてください！
-第5問からもう1度プレイしたい場合にはanotherと送ってください。
-本日は大高祭3-4HR企画にお越しいいただきありがとうございました！''')
-            )
-            # 初回クリア時（another_count == 0）にosada.jpgを送信
-            if user_states.get(user_id, {}).get("another_count", 0) == 0:
-                osada_image_url = "https://nazotoki-bot-4-7-9hls.onrender.com/static/osada1.jpg"
-                line_bot_api.push_message(
-                    user_id,
-                    ImageSendMessage(
-                        original_content_url=osada_image_url,
-                        preview_image_url=osada_image_url
-                    )
-                )
-    except LineBotApiError as e:
-        print(f"Failed to send content to {user_id}: {str(e)} - Status code: {getattr(e, 'status_code', 'N/A')}")
+# ==== 配信メッセージ（スケジューラに保存できるよう dict で表現） ====
+def text_message(text):
+    return {"type": "text", "text": text}
+
+def image_message(url):
+    return {"type": "image", "url": url}
+
+def story_message(story_msg):
+    if "text" in story_msg:
+        return text_message(story_msg["text"])
+    return image_message(story_msg["image_url"])
+
+def to_line_message(message):
+    if message["type"] == "text":
+        return TextSendMessage(text=message["text"])
+    return ImageSendMessage(original_content_url=message["url"], preview_image_url=derived_url(message["url"], "preview"))
+
+# retry_key は配信ステップごとに固定なので、引き継いだジョブが送り直しても二重に届かない
+def push_messages(user_id, messages, reply_token=None, retry_key=None):
+    line_messages = [to_line_message(m) for m in messages]
+    if reply_token:
+        try:
+            line_bot_api.reply_message(reply_token, line_messages)
+            return
+        except LineBotApiError as e:
+            # 期限切れ・使用済みのreply tokenはpushで送り直す
+            print(f"Reply failed for {user_id}, falling back to push: {str(e)}")
+    line_bot_api.push_message(user_id, line_messages, retry_key=retry_key)
+
+def notify_delivery_error(user_id, error):
+    status_code = getattr(error, 'status_code', None)
+    print(f"Failed to send content to {user_id}: {str(error)} - Status code: {status_code or 'N/A'}")
+    # 混雑・障害中にさらにpushすると悪化するので、そのときはお知らせを送らない
+    if isinstance(error, LineBotApiError) and status_code != 429 and (status_code or 0) < 500:
         line_bot_api.push_message(
             user_id,
             TextSendMessage(text="メッセージ送信中にエラーが発生しました。しばらくしてからもう一度試してください。")
         )
-        raise
 
-def send_question(user_id, qnum):
+# ==== ストーリー配信スケジューラ（webhookやジャッジ画面を待たせない） ====
+delivery_scheduler = DeliveryScheduler(push_messages, backend=state_backend, on_error=notify_delivery_error)
+
+# ==== 関数: 問題またはストーリーを送信（スケジューラに登録してすぐ戻る） ====
+@timed("send_content")
+def send_content(user_id, content_type, content_data, reply_token=None):
+    entries = []
+    if content_type == "question":
+        q = content_data
+        for story_msg in q["story_messages"]:
+            entries.append((story_message(story_msg), story_msg["delay_seconds"]))
+        entries.append((image_message(q["image_url"]["url"]), q["image_url"]["delay_seconds"]))
+        if "current_q" in user_states[user_id] and user_states[user_id]["current_q"] in [1, 4]:
+            message = "答えとなるものの写真を送ってください。"
+        else:
+            message = "答えとなるテキストを送ってください。"
+        if q["hint_keyword"]:
+            message += f" ヒントが欲しい場合には{q['hint_keyword']}と送ってください。"
+        entries.append((text_message(message), 0))
+    elif content_type == "end_story":
+        for story_msg in content_data:
+            entries.append((story_message(story_msg), story_msg["delay_seconds"]))
+        message, delay = entries[-1]
+        entries[-1] = (message, delay + 2)
+        entries.append((text_message('''ゲームクリア！お疲れ様でした！
+第5問には2つの解答が用意されています。
+もう一方の解答もぜひ考えて、試してみてください！
+第5問からもう1度プレイしたい場合にはanotherと送ってください。
+本日は大高祭3-4HR企画にお越しいいただきありがとうございました！'''), 0))
+        # 初回クリア時（another_count == 0）にosada.jpgを送信
+        if user_states.get(user_id, {}).get("another_count", 0) == 0:
+            osada_image_url = "https://nazotoki-bot-4-7-9hls.onrender.com/static/osada1.jpg"
+            entries.append((image_message(osada_image_url), 0))
+    return delivery_scheduler.submit(user_id, pack_steps(entries), reply_token=reply_token)
+
+def send_question(user_id, qnum, reply_token=None):
     if qnum < len(questions):
-        send_content(user_id, "question", questions[qnum])
+        send_content(user_id, "question", questions[qnum], reply_token=reply_token)
+
+# ==== Webhookエンドポイント（署名を確認してキューに積み、すぐ200を返す） ====
+def event_type(event):
+    message = getattr(event, "message", None)
+    return f"{event.type}/{message.type}" if message is not None else event.type
 
-# ==== Webhookエンドポイント ====
 @app.route("/callback", methods=["POST"])
 def callback():
     signature = request.headers.get("X-Line-Signature", "")
     body = request.get_data(as_text=True)
-    print(f"Received body at {os.getcwd()}: {body}")
-    print(f"Signature: {signature}")
     try:
-        handler.handle(body, signature)
+        events = handler.parser.parse(body, signature)
     except InvalidSignatureError:
-        print("Invalid signature error")
+        WEBHOOK_REJECTED.inc(reason="signature")
+        log_event("webhook_rejected", always=True, reason="signature", bytes=len(body))
         return "Invalid signature", 400
     except Exception as e:
-        print(f"Callback error: {str(e)}")
+        WEBHOOK_REJECTED.inc(reason="error")
+        log_event("webhook_rejected", always=True, reason="error", error=str(e), bytes=len(body))
         return "Internal server error", 500
+    for event in events:
+        WEBHOOK_EVENTS.inc(type=event_type(event))
+    # 本文と署名は出さず、件数と種類だけを間引いて記録する
+    log_event("webhook", bytes=len(body), events=[
+        {"type": event_type(event), "user": anonymize(getattr(event.source, "user_id", None)),
+         "redelivery": getattr(getattr(event, "delivery_context", None), "is_redelivery", None)}
+        for event in events
+    ])
+    # 同じユーザーのイベントは到着順に処理する
+    items = [(getattr(event.source, "user_id", None) or "", event) for event in events]
+    if not event_pool.submit_many(items, timeout=EVENT_SUBMIT_TIMEOUT):
+        # 混雑時はLINEの再送に任せる
+        WEBHOOK_REJECTED.inc(reason="busy")
+        log_event("webhook_rejected", always=True, reason="busy", events=len(items))
+        return "Busy", 503
     return "OK", 200
 
 # ==== メッセージ受信時の処理（テキスト） ====
 @handler.add(MessageEvent, message=TextMessage)
+@timed("handle_text")
 def handle_text(event):
     user_id = event.source.user_id
     text = event.message.text.strip().replace('\u3000', '')
@@ -336,14 +568,19 @@ def handle_text(event):
     if text in ignore_numbers:
         return
 
+    refresh_state(max_age=0)
+
     # ゲーム開始（1回のみ）
     if text.lower() == "start":
-        if user_id in user_states:
-            return  # 2度目のstartは無反応
+        def start_game():
+            if user_id in user_states:
+                return None  # 2度目のstartは無反応
+            return [user_mutation(user_id, {"current_q": 0, "game_cleared": False, "another_count": 0})]
+        # 返信・問題の配信は保存できてから（失敗したら取り消されるので、エラーを返すだけでよい）
         try:
-            user_states[user_id] = {"current_q": 0, "answers": [], "game_cleared": False, "another_count": 0}
-            save_state_to_s3()
-            send_question(user_id, 0)
+            if not transact(start_game, sync=True):
+                return
+            send_question(user_id, 0, reply_token=event.reply_token)
         except Exception as e:
             print(f"Error in handle_text (start): {str(e)}")
             line_bot_api.reply_message(
@@ -354,22 +591,21 @@ def handle_text(event):
 
     # 第5問再プレイ（2回まで）
     if text.lower() == "another":
-        try:
+        def replay_last_question():
             if user_id not in user_states:
-                user_states[user_id] = {"current_q": 4, "answers": [], "game_cleared": False, "another_count": 1}
-            else:
-                another_count = user_states[user_id].get("another_count", 0)
-                if another_count >= 2:
-                    line_bot_api.reply_message(
-                        event.reply_token,
-                        TextSendMessage(text="これ以上再プレイできません。本日は3-4HR企画にお越しいいただきありがとうございました。")
-                    )
-                    return
-                user_states[user_id]["current_q"] = 4
-                user_states[user_id]["game_cleared"] = False
-                user_states[user_id]["another_count"] = another_count + 1
-            save_state_to_s3()
-            send_question(user_id, 4)
+                return [user_mutation(user_id, {"current_q": 4, "game_cleared": False, "another_count": 1})]
+            another_count = user_states[user_id].get("another_count", 0)
+            if another_count >= 2:
+                return None
+            return [user_mutation(user_id, dict(user_states[user_id], current_q=4, game_cleared=False, another_count=another_count + 1))]
+        try:
+            if not transact(replay_last_question, sync=True):
+                line_bot_api.reply_message(
+                    event.reply_token,
+                    TextSendMessage(text="これ以上再プレイできません。本日は3-4HR企画にお越しいいただきありがとうございました。")
+                )
+                return
+            send_question(user_id, 4, reply_token=event.reply_token)
         except Exception as e:
             print(f"Error in handle_text (another): {str(e)}")
             line_bot_api.reply_message(
@@ -401,6 +637,8 @@ def handle_text(event):
         if qnum < len(questions):
             q = questions[qnum]
             if q["hint_keyword"] and text.lower() == q["hint_keyword"].lower():
+                HINT_REQUESTS.inc(qnum=qnum)
+                record_stat("hint", qnum)
                 line_bot_api.reply_message(
                     event.reply_token,
                     TextSendMessage(text=q["hint_text"])
@@ -413,10 +651,15 @@ def handle_text(event):
                 )
                 return
             elif isinstance(q["correct_answer"], str) and q["correct_answer"] != "image_based" and text.lower() == q["correct_answer"].lower():
+                ANSWERS.inc(qnum=qnum, result="correct")
+                def advance():
+                    # 別のワーカーがすでに進めていたら何もしない
+                    if user_states.get(user_id, {}).get("current_q") != qnum:
+                        return None
+                    return [user_mutation(user_id, dict(user_states[user_id], current_q=qnum + 1)), stat_mutation("answer", qnum)]
                 try:
-                    user_states[user_id]["current_q"] += 1
-                    save_state_to_s3()
-                    send_question(user_id, user_states[user_id]["current_q"])
+                    if transact(advance, sync=True):
+                        send_question(user_id, qnum + 1, reply_token=event.reply_token)
                 except Exception as e:
                     print(f"Error in handle_text (correct answer): {str(e)}")
                     line_bot_api.reply_message(
@@ -425,6 +668,8 @@ def handle_text(event):
                     )
                 return
             else:
+                ANSWERS.inc(qnum=qnum, result="incorrect")
+                record_stat("answer", qnum)
                 if qnum in [0, 2, 3]:
                     line_bot_api.reply_message(
                         event.reply_token,
@@ -437,10 +682,15 @@ def handle_text(event):
         TextSendMessage(text="startと送ると、初めからやり直せます")
     )
 
-# ==== 画像メッセージ処理（S3アップロード対応） ====
+# ==== 画像取り込みワーカー ====
+image_ingestor = ImageIngestor()
+
+# ==== 画像メッセージ処理（S3へストリーミングアップロード） ====
 @handler.add(MessageEvent, message=ImageMessage)
+@timed("handle_image")
 def handle_image(event):
     user_id = event.source.user_id
+    refresh_state(max_age=0)
 
     if user_id not in user_states:
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text="まずはstartと送って始めてね"))
@@ -451,37 +701,226 @@ def handle_image(event):
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text="この問題はテキストで解答してください"))
         return
 
+    ANSWERS.inc(qnum=qnum, result="image")
+
+    # 受け付けたことを先に返し、ダウンロードとアップロードは裏で行う。
+    # イベントIDは判定待ちに追加するときに一緒に書く（取り込みのスレッドに引き継ぐ）
+    event_id = getattr(event_context, "event_id", None)
+    event_context.event_id = None
+    line_bot_api.reply_message(event.reply_token, TextSendMessage(text="判定中です。しばらくお待ちください。"))
+    image_ingestor.submit(ingest_image, user_id, qnum, event.message.id, event_id)
+
+@timed("ingest_image")
+def ingest_image(user_id, qnum, message_id, event_id=None):
     try:
-        message_content = line_bot_api.get_message_content(event.message.id)
+        message_content = line_bot_api.get_message_content(message_id)
         unique_filename = f"{user_id}_{qnum}_{uuid.uuid4()}.jpg"
-        file_bytes = b"".join([chunk for chunk in message_content.iter_content(chunk_size=1024)])
+        with spool() as copy:
+            size, sha256 = stream_to_s3(s3_client, AWS_S3_BUCKET_NAME, unique_filename, message_content, copy_to=copy)
+            s3_url = s3_object_url(unique_filename)
+            entry = {"user_id": user_id, "qnum": qnum, "img_url": s3_url, "size": size, "sha256": sha256}
 
-        s3_client.put_object(Bucket=AWS_S3_BUCKET_NAME, Key=unique_filename, Body=file_bytes, ACL='public-read', ContentType='image/jpeg')
-        s3_url = f"https://{AWS_S3_BUCKET_NAME}.s3.{AWS_S3_REGION}.amazonaws.com/{unique_filename}"
+            # 判定画面用の縮小画像（失敗しても元画像で判定できる）
+            try:
+                thumb_key = f"{THUMB_PREFIX}{unique_filename}"
+                upload_thumbnail(s3_client, AWS_S3_BUCKET_NAME, thumb_key, copy)
+                entry["thumb_url"] = s3_object_url(thumb_key)
+            except Exception as e:
+                print(f"Failed to create thumbnail for {unique_filename}: {str(e)}")
 
-        token = str(uuid.uuid4())
-        pending_judges.append({"user_id": user_id, "qnum": qnum, "img_url": s3_url, "token": token})
-        save_state_to_s3()
+            match = None
+            if IMAGE_MATCH_MODE != "off":
+                try:
+                    entry["phash"] = format_hash(dhash(copy))
+                    match = image_index.match(qnum, entry["phash"])
+                except Exception as e:
+                    print(f"Failed to hash {unique_filename}: {str(e)}")
+            if match:
+                entry["suggestion"] = match
 
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="判定中です。しばらくお待ちください。"))
+        entry["token"] = str(uuid.uuid4())
+        entry["received_at"] = time.time()
+        # 取り込み中に届いた再送がすでに追加していれば、こちらは捨てる
+        event_context.event_id = event_id
+        try:
+            if not save_mutations([{"op": "pending_add", "entry": entry}]):
+                print(f"Skipping image for already processed event {event_id}")
+                return
+        finally:
+            event_context.event_id = None
+
+        # 判定済みの画像とほぼ同じなら、同じ判定をそのまま下す
+        if match and IMAGE_MATCH_MODE == "auto":
+            auto_judge(entry, match)
 
     except LineBotApiError as e:
         print(f"LineBotApi error: {str(e)} - Status code: {getattr(e, 'status_code', 'N/A')}")
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="サーバーエラー：API接続に失敗しました。"))
+        push_error(user_id, "サーバーエラー：API接続に失敗しました。")
+    except ImageTooLargeError as te:
+        print(f"Image too large: {str(te)}")
+        push_error(user_id, "画像のサイズが大きすぎます。小さくしてからもう一度送ってください。")
     except PermissionError as pe:
         print(f"Permission error: {str(pe)}")
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="サーバーエラー：書き込み権限がありません。"))
+        push_error(user_id, "サーバーエラー：書き込み権限がありません。")
     except IOError as ioe:
         print(f"IO error: {str(ioe)}")
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="サーバーエラー：ファイル操作に失敗しました。"))
+        push_error(user_id, "サーバーエラー：ファイル操作に失敗しました。")
     except Exception as e:
         print(f"Unexpected error: {str(e)}")
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="画像の処理中にエラーが発生しました。もう一度試してください。"))
+        push_error(user_id, "画像の処理中にエラーが発生しました。もう一度試してください。")
+
+def auto_judge(entry, match):
+    user_id, qnum, token = entry["user_id"], entry["qnum"], entry["token"]
+    extra = {"auto_from": match["token"], "distance": match["distance"]}
+    if transact(lambda: verdict_mutations(user_id, qnum, match["result"], token, extra), sync=True):
+        print(f"Auto-judged {token} as {match['result']} (matched {match['token']}, distance {match['distance']})")
+        deliver_verdict(user_id, qnum, match["result"])
+
+def push_error(user_id, text):
+    try:
+        line_bot_api.push_message(user_id, TextSendMessage(text=text))
+    except LineBotApiError as e:
+        print(f"Failed to notify {user_id}: {str(e)}")
+
+# ==== ユーザーごとの担当ワーカー ====
+# KeyedWorkerPool が順番を守れるのはプロセスの中だけ。LINEの webhook は同じユーザーの分でも別々のワーカーに届くので、
+# 複数ワーカーのときは状態ストアに担当（期限付き）を書いてから処理し、担当中の他のワーカーは開放を待つ。
+# 担当はそのユーザーの待ちがなくなったら開放する（event_pool の on_idle）。止まったワーカーの担当は期限で外れる。
+# 1ワーカーなら書かない（gunicorn.conf.py の post_fork で APP_MULTI_WORKER / multi_worker を立てる）
+USER_OWNER_SECONDS = float(os.environ.get("USER_OWNER_SECONDS", "10"))
+USER_OWNER_WAIT = float(os.environ.get("USER_OWNER_WAIT", str(USER_OWNER_SECONDS * 2)))
+multi_worker = os.environ.get("APP_MULTI_WORKER") == "1"
+event_owners = state_store.state["event_owners"]  # user_id -> [担当ワーカー, 期限]
+held_users = {}  # このプロセスが担当中のユーザー user_id -> 期限
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def owner_mutation(user_id, until):
+    return {"op": "owner", "user_id": user_id, "worker": worker_name(), "until": until}
+
+def acquire_user(user_id):
+    if not multi_worker or not user_id:
+        return True
+    if held_users.get(user_id, 0) - time.time() > USER_OWNER_SECONDS / 2:
+        return True
+    me = worker_name()
+    deadline = time.time() + USER_OWNER_WAIT
+    delay = 0.05
+    while True:
+        now = time.time()
+
+        def take():
+            owner = event_owners.get(user_id)
+            if owner is not None and owner[0] != me and owner[1] > now:
+                return None
+            return [owner_mutation(user_id, now + USER_OWNER_SECONDS)]
+        # 他のワーカーの開放を見落とさないよう、毎回最新まで読んでから判断する
+        refresh_state(max_age=0)
+        try:
+            if transact(take, sync=True):
+                held_users[user_id] = now + USER_OWNER_SECONDS
+                return True
+        except Exception as e:
+            print(f"Failed to take over events for {user_id}: {str(e)}")
+        if now >= deadline:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 0.2)
+
+def release_user(user_id):
+    if held_users.pop(user_id, None) is None:
+        return
+    me = worker_name()
+    try:
+        transact(lambda: [owner_mutation(user_id, 0)] if event_owners.get(user_id, [None])[0] == me else None, sync=True)
+    except Exception as e:
+        print(f"Failed to release events for {user_id}: {str(e)}")
+
+# ==== イベントの振り分け（ワーカースレッドで実行） ====
+EVENT_SUBMIT_TIMEOUT = 2.0
+
+def dispatch_event(event):
+    # キャッシュから起動した直後は、最新の状態に追いつくまで待つ（古い状態で返信しない）
+    if not state_ready.wait(STATE_READY_TIMEOUT):
+        print("State is still catching up; handling event with cached state")
+    # 同じユーザーのイベントを他のワーカーが処理中なら、終わるまで待つ
+    user_id = getattr(event.source, "user_id", None)
+    if not acquire_user(user_id):
+        print(f"Events for {user_id} are still owned by another worker; handling anyway")
+    # LINEからの再送は、処理済みならS3やLINEの処理を繰り返さずに捨てる。
+    # 処理済みとして記録するのは状態を変えたイベントだけ（案内の返信などは、再送されたらもう一度返信する）
+    event_id = getattr(event, "webhook_event_id", None)
+    if event_id and getattr(getattr(event, "delivery_context", None), "is_redelivery", False):
+        refresh_state()
+        if event_id in seen_events:
+            print(f"Skipping redelivered event {event_id}")
+            return
+
+    event_context.event_id = event_id
+    try:
+        if isinstance(event, MessageEvent):
+            if isinstance(event.message, TextMessage):
+                handle_text(event)
+            elif isinstance(event.message, ImageMessage):
+                handle_image(event)
+    finally:
+        event_context.event_id = None
+
+event_pool = KeyedWorkerPool(dispatch_event, on_idle=release_user)
+
+# ==== 判定結果を状態の変更に変換（状態は直接書き換えない） ====
+# states: まとめて判定するとき、同じ保存の中で先に変えたユーザーの状態 {user_id: state}（ここで更新する）
+def verdict_mutations(user_id, qnum, result, token, extra=None, states=None):
+    judge_to_process = pending_judges.get(token)
+    if judge_to_process is None or judge_to_process["user_id"] != user_id or judge_to_process["qnum"] != qnum:
+        return None
+    mutations = []
+    state = states[user_id] if states and user_id in states else user_states.get(user_id)
+    if state is not None:
+        new_state = None
+        if qnum == 4 and result in ("good_end", "bad_end"):
+            new_state = dict(state, game_cleared=True)
+        elif qnum != 4 and result == "correct":
+            new_state = dict(state, current_q=state["current_q"] + 1)
+        if new_state is not None:
+            mutations.append(user_mutation(user_id, new_state))
+            if states is not None:
+                states[user_id] = new_state
+    mutations.append({"op": "judged", "token": token, "entry": {
+        "user_id": user_id,
+        "qnum": qnum,
+        "img_url": judge_to_process["img_url"],
+        "thumb_url": judge_to_process.get("thumb_url"),
+        "phash": judge_to_process.get("phash"),
+        "result": result,
+        "token": token,
+        "judged_at": time.time(),
+        **(extra or {})
+    }})
+    return mutations
+
+# ==== 判定結果をプレイヤーに送る（保存が済んでから配信キューに積む） ====
+def deliver_verdict(user_id, qnum, result):
+    VERDICTS.inc(qnum=qnum, result=result)
+    if qnum == 4:
+        if result == "good_end":
+            send_content(user_id, "end_story", questions[qnum]["good_end_story"])
+        elif result == "bad_end":
+            send_content(user_id, "end_story", questions[qnum]["bad_end_story"])
+        elif result == "retry":
+            delivery_scheduler.submit(user_id, [{"messages": [text_message("「ブブー、不正解です。別の画像を送ってください。」")], "delay": 0}])
+    else:
+        if result == "correct":
+            if user_id in user_states:
+                send_question(user_id, user_states[user_id]["current_q"])
+        elif result == "incorrect":
+            delivery_scheduler.submit(user_id, [{"messages": [text_message(f"「ブブー、不正解です。もしもヒントが欲しければ、{questions[qnum]['hint_keyword']}と送ってください。」")], "delay": 0}])
 
 # ==== 判定フォーム ====
 @app.route("/judge", methods=["GET", "POST"])
 def judge():
-    global pending_judges, judged_history, used_tokens
+    refresh_state()
 
     if request.method == "POST":
         user_id = request.form.get("user_id")
@@ -496,51 +935,347 @@ def judge():
         if user_id and qnum and result and token:
             try:
                 qnum = int(qnum)
-                judge_to_process = next((j for j in pending_judges if j["user_id"] == user_id and j["qnum"] == qnum and j["token"] == token), None)
-                if judge_to_process:
-                    used_tokens.add(token)
-                    if qnum == 4:
-                        if result == "good_end":
-                            user_states[user_id]["game_cleared"] = True
-                            send_content(user_id, "end_story", questions[qnum]["good_end_story"])
-                        elif result == "bad_end":
-                            user_states[user_id]["game_cleared"] = True
-                            send_content(user_id, "end_story", questions[qnum]["bad_end_story"])
-                        elif result == "retry":
-                            line_bot_api.push_message(
-                                user_id,
-                                TextSendMessage(text="「ブブー、不正解です。別の画像を送ってください。」")
-                            )
-                    else:
-                        if result == "correct":
-                            if user_id in user_states:
-                                user_states[user_id]["current_q"] += 1
-                                send_question(user_id, user_states[user_id]["current_q"])
-                        elif result == "incorrect":
-                            line_bot_api.push_message(
-                                user_id,
-                                TextSendMessage(text=f"「ブブー、不正解です。もしもヒントが欲しければ、{questions[qnum]['hint_keyword']}と送ってください。」")
-                            )
-
-                    judged_history.append({
-                        "user_id": user_id,
-                        "qnum": qnum,
-                        "img_url": judge_to_process["img_url"],
-                        "result": result,
-                        "token": token
-                    })
-                    pending_judges = [j for j in pending_judges if not (j["user_id"] == user_id and j["qnum"] == qnum and j["token"] == token)]
-                    save_state_to_s3()
-            except LineBotApiError as e:
-                print(f"Failed to send result to {user_id}: {str(e)} - Status code: {getattr(e, 'status_code', 'N/A')}")
-                return "API error", 500
             except ValueError:
                 print(f"Invalid qnum: {qnum}")
                 return "Invalid data", 400
+            # 同じ回答を別のジャッジが確保していれば受け付けない（/judge/claim を参照）
+            judge_id = request.form.get("judge_id") or request.remote_addr
+            if pending_judges.leased_by_other(token, judge_id):
+                print(f"Token {token} is already claimed by another judge")
+                return "Already being judged", 409
+            # 別のワーカーで先に判定・確保されていれば何もしない
+            if not transact(lambda: None if pending_judges.leased_by_other(token, judge_id) else verdict_mutations(user_id, qnum, result, token), sync=True):
+                if pending_judges.leased_by_other(token, judge_id):
+                    print(f"Token {token} was claimed by another judge")
+                    return "Already being judged", 409
+                if token in used_tokens:
+                    print(f"Token {token} was judged by another worker")
+                    return "Already judged", 409
+                print(f"No pending answer for token: {token}")
+                return "Not found", 404
+            deliver_verdict(user_id, qnum, result)
+        else:
+            return "Invalid data", 400
+
+    if request.method == "POST" and wants_json():
+        return jsonify({"ok": True, "seq": state_store.seq})
 
-    response = make_response(render_template("judge.html", judges=pending_judges, history=judged_history))
+    with state_store.lock:
+        feed_seq = state_store.seq
+        # 判定候補が付いているものを先に並べる（確認するだけで済むので）
+        judges = sorted(pending_judges, key=lambda j: "suggestion" not in j)
+        claims = pending_judges.leases()
+        history, history_next = judged_history.page(None, HISTORY_PAGE_SIZE)
+    response = make_response(render_template("judge.html", judges=judges, history=history, history_next=history_next, feed_seq=feed_seq,
+                                             claims=claims, server_time=time.time(), lease_seconds=CLAIM_LEASE_SECONDS))
     response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     return response
 
+# ==== まとめて判定 ====
+# POST {"verdicts": [{"token": str, "result": str}, ...], "judge_id": str}
+# すべての判定を1回の保存（1つのジャーナル）で適用し、プレイヤーへの配信は配信キューに任せる。
+# 結果はトークンごとに返す: judged / duplicate（判定済み）/ claimed（他のジャッジが処理中）/
+# not_found（判定待ちにない）/ invalid（その問題にない判定）
+JUDGE_BULK_MAX = int(os.environ.get("JUDGE_BULK_MAX", "200"))
+
+def valid_result(qnum, result):
+    return result in (("good_end", "bad_end", "retry") if qnum == 4 else ("correct", "incorrect"))
+
+def bulk_verdict_mutations(verdicts, judge_id):
+    mutations = []
+    states = {}
+    for token, result, user_id, qnum in verdicts:
+        if pending_judges.leased_by_other(token, judge_id):
+            continue
+        mutations.extend(verdict_mutations(user_id, qnum, result, token, states=states) or [])
+    return mutations or None
+
+@app.route("/judge/bulk", methods=["POST"])
+def judge_bulk():
+    data = request.get_json(silent=True) or {}
+    verdicts = data.get("verdicts")
+    if not isinstance(verdicts, list) or not 0 < len(verdicts) <= JUDGE_BULK_MAX or \
+            not all(isinstance(v, dict) and isinstance(v.get("token"), str) and isinstance(v.get("result"), str) for v in verdicts):
+        return jsonify({"ok": False, "error": f"verdicts must be a list of 1 to {JUDGE_BULK_MAX} {{token, result}} objects"}), 400
+    judge_id = data.get("judge_id") or request.remote_addr
+    refresh_state()
+
+    results = {}
+    claimed = []  # [(token, result, user_id, qnum)]
+    for verdict in verdicts:
+        token, result = verdict["token"], verdict["result"]
+        if token in results:
+            continue
+        entry = pending_judges.get(token)
+        if token in used_tokens:
+            results[token] = "duplicate"
+        elif entry is None:
+            results[token] = "not_found"
+        elif not valid_result(entry["qnum"], result):
+            results[token] = "invalid"
+        elif pending_judges.leased_by_other(token, judge_id):
+            results[token] = "claimed"
+        else:
+            results[token] = None
+            claimed.append((token, result, entry["user_id"], entry["qnum"]))
+
+    applied = transact(lambda: bulk_verdict_mutations(claimed, judge_id), sync=True) if claimed else None
+    judged = {m["token"] for m in applied or [] if m["op"] == "judged"}
+    for token, result, user_id, qnum in claimed:
+        if token in judged:
+            results[token] = "judged"
+            deliver_verdict(user_id, qnum, result)
+        elif pending_judges.leased_by_other(token, judge_id):
+            # 保存するまでに別のワーカーで確保された
+            results[token] = "claimed"
+        else:
+            # 別のワーカーで先に判定された
+            results[token] = "not_found"
+    print(f"Bulk judged {len(judged)} of {len(verdicts)} answers")
+    return jsonify({"ok": True, "seq": state_store.seq, "results": results})
+
+# ==== 判定待ちの確保 ====
+# POST {"judge_id": str, "claim": [token, ...], "release": [token, ...]}
+# ジャッジの画面がカードを開いた・選んだときに呼ぶ。確保は状態の変更として保存するので全ワーカーで共通。
+# 期限（CLAIM_LEASE_SECONDS）内に判定しなければ自然に外れるので、画面は開いている間ときどき呼び直す。
+# 返すのは確保できたトークン（claimed）と他のジャッジが確保中・判定待ちにないトークン（denied）
+JUDGE_CLAIM_MAX = 50
+
+def claim_mutations(judge_id, claim, release):
+    now = time.time()
+    mutations = []
+    for token in claim:
+        lease = pending_judges.lease(token)
+        if token not in pending_judges or pending_judges.leased_by_other(token, judge_id, now):
+            continue
+        # 期限まで半分以上残っていれば書き直さない（カードを選び直すたびに保存しないように）
+        if lease is not None and lease[0] == judge_id and lease[1] - now > CLAIM_LEASE_SECONDS / 2:
+            continue
+        mutations.append({"op": "claim", "token": token, "judge_id": judge_id, "until": now + CLAIM_LEASE_SECONDS})
+    for token in release:
+        lease = pending_judges.lease(token)
+        if token not in claim and lease is not None and lease[0] == judge_id:
+            mutations.append({"op": "claim", "token": token, "judge_id": judge_id, "until": 0})
+    return mutations or None
+
+@app.route("/judge/claim", methods=["POST"])
+def judge_claim():
+    data = request.get_json(silent=True) or {}
+    judge_id, claim, release = data.get("judge_id"), data.get("claim", []), data.get("release", [])
+    if not isinstance(judge_id, str) or not judge_id or \
+            not all(isinstance(tokens, list) and len(tokens) <= JUDGE_CLAIM_MAX and all(isinstance(t, str) for t in tokens) for tokens in (claim, release)):
+        return jsonify({"ok": False, "error": f"judge_id and lists of up to {JUDGE_CLAIM_MAX} tokens are required"}), 400
+    refresh_state()
+    if claim or release:
+        transact(lambda: claim_mutations(judge_id, claim, release), sync=True)
+    now = time.time()
+    claimed = [token for token in claim if token in pending_judges and not pending_judges.leased_by_other(token, judge_id, now)]
+    return jsonify({"ok": True, "seq": state_store.seq, "server_time": now, "lease_seconds": CLAIM_LEASE_SECONDS,
+                    "claimed": claimed, "denied": [token for token in claim if token not in claimed]})
+
+def wants_json():
+    best = request.accept_mimetypes.best_match(["application/json", "text/html"])
+    return best == "application/json"
+
+# ==== 判定履歴のページング（新しい順・カーソルより前を返す） ====
+HISTORY_PAGE_SIZE = 20
+
+@app.route("/judge/history", methods=["GET"])
+def judge_history():
+    refresh_state()
+    before = request.args.get("before", type=int)
+    limit = max(1, min(request.args.get("limit", HISTORY_PAGE_SIZE, type=int), 100))
+    items, next_cursor = judged_history.page(before, limit)
+    return jsonify({"items": items, "next": next_cursor})
+
+# ==== 判定フィード（差分のみ返す。ETag/304・ロングポーリング対応） ====
+# seq はジャーナル番号なので、どのワーカーに問い合わせても同じ意味になる
+FEED_MAX_WAIT = 25
+FEED_REFRESH_INTERVAL = 1.0
+# 待っている間はリクエストのスレッドを1本ふさぐので、同時に待たせるのは FEED_MAX_WAITERS 本まで。
+# 同期ワーカー（1プロセス1リクエスト）では webhook まで止まるので待たせない。
+# 待てなかったときはすぐ返し、Retry-After 秒後に問い合わせ直してもらう（短い間隔の ETag ポーリング）。
+FEED_MAX_WAITERS = int(os.environ.get("FEED_MAX_WAITERS", "4"))
+FEED_RETRY_AFTER = 5
+feed_waiters = threading.BoundedSemaphore(FEED_MAX_WAITERS) if FEED_MAX_WAITERS > 0 else None
+
+@contextmanager
+def feed_wait_slot():
+    if feed_waiters is None or not request.environ.get("wsgi.multithread") or not feed_waiters.acquire(blocking=False):
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        feed_waiters.release()
+
+def reset_payload(state):
+    pending = state["pending_judges"]
+    history, history_next = state["judged_history"].page(None, HISTORY_PAGE_SIZE)
+    return {"seq": state_store.seq, "reset": True, "pending": list(pending), "claims": pending.leases(),
+            "history": history, "history_next": history_next, "server_time": time.time()}
+
+# since より後の差分（なければ None）。since が古すぎる・進みすぎているときは全件を返す
+def feed_payload(since):
+    with state_store.lock:
+        changes = judge_feed.since(since) if since <= state_store.seq else None
+        if changes is None:
+            # 全件はジャーナルに書かれた分だけで作る（まだ書いていない判定は、書けたときに差分で届く）
+            return state_store.read_committed(reset_payload)
+    if not changes:
+        return None
+    return {"seq": changes[-1]["seq"], "reset": False, "changes": changes, "server_time": time.time()}
+
+# 他のワーカーの変更も取り込みながら、since より新しい変更を最大 timeout 秒待つ
+def wait_for_feed(since, timeout):
+    deadline = time.time() + timeout
+    refresh_state()
+    while judge_feed.seq <= since and time.time() < deadline:
+        judge_feed.wait(since, min(FEED_REFRESH_INTERVAL, max(0, deadline - time.time())))
+        refresh_state()
+
+# ETag は返した時点の seq。since を省くと If-None-Match の ETag をカーソルにする。
+# 変化がなければ、If-None-Match が今の ETag と同じときだけ 304（条件付きでなければ空の差分を返す）
+@app.route("/judge/feed", methods=["GET"])
+def judge_feed_endpoint():
+    since = request.args.get("since", type=int)
+    if since is None:
+        since = max((int(tag) for tag in request.if_none_match.as_set() if tag.isdigit()), default=0)
+    wait = min(request.args.get("wait", 0, type=int), FEED_MAX_WAIT)
+    with feed_wait_slot() as can_wait:
+        wait_for_feed(since, wait if can_wait else 0)
+
+    payload = feed_payload(since)
+    if payload is None and request.if_none_match.contains(str(since)):
+        response = make_response("", 304)
+        response.headers['ETag'] = f'"{since}"'
+    else:
+        payload = payload or {"seq": since, "reset": False, "changes": [], "server_time": time.time()}
+        response = jsonify(payload)
+        response.headers['ETag'] = f'"{payload["seq"]}"'
+    response.headers['Cache-Control'] = 'no-cache'
+    if wait and not can_wait:
+        response.headers['Retry-After'] = str(FEED_RETRY_AFTER)
+    return response
+
+@app.route("/judge/stream", methods=["GET"])
+def judge_stream():
+    since = request.headers.get("Last-Event-ID", type=int)
+    if since is None:
+        since = request.args.get("since", 0, type=int)
+
+    def events(seq):
+        with feed_wait_slot() as can_wait:
+            # 待てないときは今ある差分だけを送って切る（EventSource が retry ミリ秒後につなぎ直す）
+            yield f"retry: {FEED_RETRY_AFTER * 1000}\n\n"
+            if not can_wait:
+                wait_for_feed(seq, 0)
+                payload = feed_payload(seq)
+                if payload is not None:
+                    yield f"id: {payload['seq']}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+                return
+            while True:
+                wait_for_feed(seq, 15)
+                payload = feed_payload(seq)
+                if payload is None:
+                    yield ": keepalive\n\n"
+                    continue
+                seq = payload["seq"]
+                yield f"id: {seq}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    response = Response(stream_with_context(events(since)), mimetype="text/event-stream")
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# ==== 配信キューの状態 ====
+@app.route("/status", methods=["GET"])
+def status():
+    return jsonify({
+        "events": event_pool.stats(),
+        "delivery": delivery_scheduler.stats(),
+        "pending": {"count": len(pending_judges), "oldest_age_seconds": round(oldest_pending_age(), 1)},
+        "state_writes": state_store.write_stats(),
+        "line": line_bot_api.stats(),
+        "startup": dict(startup, state_ready=state_ready.is_set()),
+    })
+
+# ==== 進み具合の集計（状態と一緒に保存された値を返すだけ。全件は読まない） ====
+@app.route("/stats", methods=["GET"])
+def stats():
+    refresh_state()
+    with state_store.lock:
+        summary = analytics.summary(len(questions))
+    summary["pending"] = {"count": len(pending_judges), "oldest_age_seconds": round(oldest_pending_age(), 1)}
+    summary["seq"] = state_store.seq
+    return jsonify(summary)
+
+# ==== Prometheus 形式の計測値 ====
+def oldest_pending_age():
+    oldest = pending_judges.oldest(1)
+    return round(time.time() - oldest[0]["received_at"], 3) if oldest and "received_at" in oldest[0] else 0
+
+registry.gauge("nazotoki_pending_judges", "Answers waiting for a judge", lambda: len(pending_judges))
+registry.gauge("nazotoki_pending_oldest_age_seconds", "Age of the oldest answer waiting for a judge", oldest_pending_age)
+registry.gauge("nazotoki_players", "Players with saved state", lambda: len(user_states))
+registry.gauge("nazotoki_event_queue_depth", "Webhook events waiting for a worker", lambda: event_pool.stats()["depth"])
+registry.gauge("nazotoki_delivery_steps_pending", "Story steps waiting to be sent", lambda: delivery_scheduler.stats()["steps_pending"])
+registry.gauge("nazotoki_state_dirty_changes", "State changes not yet written", lambda: state_store.write_stats()["dirty"])
+
+def startup_gauge(name):
+    return lambda: [({}, startup[name])] if startup[name] is not None else []
+
+registry.gauge("nazotoki_time_to_first_request_seconds", "Seconds from process start to the first request served",
+               startup_gauge("first_request_seconds"))
+registry.gauge("nazotoki_state_ready_seconds", "Seconds from process start until state caught up with the store",
+               startup_gauge("state_ready_seconds"))
+
+@app.before_request
+def record_first_request():
+    if startup["first_request_seconds"] is not None:
+        return
+    startup["first_request_seconds"] = round(time.time() - startup["started_at"], 3)
+    log_event("first_request", always=True, seconds=startup["first_request_seconds"], path=request.path,
+              state_source=startup["state_source"], state_ready=state_ready.is_set())
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+# ==== 起動後の裏処理（プロセスごとに1回） ====
+# キャッシュから起動したときは S3 の最新に追いつき、止まったプロセスが配信しきれなかったストーリーを引き継ぐ
+def catch_up_state():
+    try:
+        if startup["state_source"] == "cache" and not state_ready.is_set():
+            state_store.revalidate()
+        else:
+            state_store.refresh()
+    except Exception as e:
+        # 書き込みは競合検出で守られているので、キャッシュのまま続ける
+        print(f"Failed to catch up state: {str(e)}")
+    mark_state_ready()
+    try:
+        state_store.save_cache()
+    except Exception as e:
+        print(f"Failed to save state cache: {str(e)}")
+    try:
+        delivery_scheduler.restore()
+    except Exception as e:
+        print(f"Failed to restore delivery jobs: {str(e)}")
+
+catch_up_pid = None
+
+def start_state_catch_up():
+    global catch_up_pid
+    if catch_up_pid == os.getpid():
+        return
+    catch_up_pid = os.getpid()
+    start_derived_images()
+    threading.Thread(target=catch_up_state, name="state-catch-up", daemon=True).start()
+
+# gunicorn の preload では親プロセスでスレッドを起こさず、ワーカーの post_fork で起こす（gunicorn.conf.py）
+if os.environ.get("APP_PRELOAD") != "1":
+    start_state_catch_up()
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import time
+import base64
+import hashlib
+import hmac
+import threading
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# ==== webhook の署名（LINE と同じ HMAC-SHA256 → Base64） ====
+def sign(channel_secret, body):
+    digest = hmac.new(channel_secret.encode("utf-8"), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+def sample_jpeg(path=None):
+    if path:
+        with open(path, "rb") as f:
+            return f.read()
+    from PIL import Image
+    out = io.BytesIO()
+    Image.new("RGB", (1024, 768), (200, 180, 160)).save(out, "JPEG", quality=85)
+    return out.getvalue()
+
+
+# ==== ベンチマーク用の LINE Messaging API もどき ====
+# reply / push を受け取って記録し、コンテンツ取得には画像を返す。
+# latency 秒だけ待ってから応答する（本物のAPIの往復時間の代わり）。
+# reply token は "{user_id}:{連番}" の形で発行し、どのプレイヤー宛ての返信かを記録する。
+class FakeLine:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.05, content=None):
+        self.latency = latency
+        self.content = content if content is not None else sample_jpeg()
+        self.messages = defaultdict(list)   # {user_id: [(受信時刻, 種類, [メッセージ])]}
+        self.replied = {}                    # {reply_token: 受信時刻}
+        self.stats = {"reply": 0, "push": 0, "content": 0, "content_bytes": 0, "messages": 0}
+        self.cond = threading.Condition()
+        line = self
+
+        class Handler(_Handler):
+            api = line
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-line", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def record(self, kind, user_id, messages, reply_token=None):
+        now = time.time()
+        with self.cond:
+            self.stats[kind] += 1
+            self.stats["messages"] += len(messages)
+            self.messages[user_id].append((now, kind, messages))
+            if reply_token:
+                self.replied[reply_token] = now
+            self.cond.notify_all()
+
+    # reply_token への返信が届くまで待つ。届いた時刻か None
+    def wait_reply(self, reply_token, timeout):
+        with self.cond:
+            self.cond.wait_for(lambda: reply_token in self.replied, timeout)
+            return self.replied.get(reply_token)
+
+    # user_id 宛てのメッセージが count 件を超えるまで待つ
+    def wait_messages(self, user_id, count, timeout):
+        with self.cond:
+            return self.cond.wait_for(lambda: len(self.messages[user_id]) > count, timeout)
+
+    def message_count(self, user_id):
+        with self.cond:
+            return len(self.messages[user_id])
+
+    def snapshot(self):
+        with self.cond:
+            return dict(self.stats)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    api = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Line-Request-Id", "bench")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.api.latency)
+        data = json.loads(body or b"{}")
+        if self.path == "/v2/bot/message/reply":
+            token = data.get("replyToken", "")
+            self.api.record("reply", token.split(":")[0], data.get("messages", []), token)
+        elif self.path == "/v2/bot/message/push":
+            self.api.record("push", data.get("to"), data.get("messages", []))
+        else:
+            return self._send(404, b'{"message":"Not found"}')
+        self._send(200, b"{}")
+
+    def do_GET(self):
+        if self.path == "/_stats":
+            return self._send(200, json.dumps(self.api.snapshot()).encode("utf-8"))
+        if self.path.startswith("/v2/bot/message/") and self.path.endswith("/content"):
+            time.sleep(self.api.latency)
+            with self.api.cond:
+                self.api.stats["content"] += 1
+                self.api.stats["content_bytes"] += len(self.api.content)
+            return self._send(200, self.api.content, "image/jpeg")
+        self._send(404, b'{"message":"Not found"}')
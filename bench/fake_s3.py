@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import threading
+from urllib.parse import urlparse, parse_qs, unquote
+from xml.sax.saxutils import escape
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import xml.etree.ElementTree as ET
+
+
+# ==== ベンチマーク用の S3 もどき ====
+# アプリが使う操作だけを、パス形式（/バケット/キー）でメモリ上に実装する:
+#   PutObject（If-None-Match: * 対応）, GetObject, ListObjectsV2, DeleteObjects
+# 書き込み・読み込みのバイト数と回数を数える（GET /_stats で JSON を返す）。
+class FakeS3:
+    def __init__(self, host="127.0.0.1", port=0):
+        self.objects = {}   # {(bucket, key): bytes}
+        self.stats = {"put": 0, "put_bytes": 0, "put_conflicts": 0, "get": 0, "get_bytes": 0, "list": 0, "delete": 0}
+        self.lock = threading.Lock()
+        store = self
+
+        class Handler(_Handler):
+            s3 = store
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-s3", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, objects=len(self.objects))
+
+
+def _decode_aws_chunked(body):
+    # <16進サイズ>[;chunk-signature=...]\r\n<データ>\r\n ... 0\r\n<トレーラー>\r\n\r\n
+    out = bytearray()
+    pos = 0
+    while True:
+        end = body.index(b"\r\n", pos)
+        size = int(body[pos:end].split(b";")[0], 16)
+        pos = end + 2
+        if size == 0:
+            return bytes(out)
+        out += body[pos:pos + size]
+        pos += size + 2
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    s3 = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _split(self):
+        parsed = urlparse(self.path)
+        parts = parsed.path.lstrip("/").split("/", 1)
+        bucket = unquote(parts[0])
+        key = unquote(parts[1]) if len(parts) > 1 else ""
+        return bucket, key, parse_qs(parsed.query, keep_blank_values=True)
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    while self.rfile.readline() not in (b"\r\n", b""):
+                        pass
+                    break
+                body += self.rfile.read(size)
+                self.rfile.readline()
+            body = bytes(body)
+        else:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if "aws-chunked" in self.headers.get("Content-Encoding", "") or \
+                self.headers.get("x-amz-content-sha256", "").startswith("STREAMING-"):
+            body = _decode_aws_chunked(body)
+        return body
+
+    def _send(self, status, body=b"", content_type="application/xml", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _error(self, status, code, message):
+        body = f"<?xml version=\"1.0\" encoding=\"UTF-8\"?><Error><Code>{code}</Code><Message>{message}</Message></Error>"
+        self._send(status, body.encode("utf-8"))
+
+    def do_PUT(self):
+        bucket, key, _ = self._split()
+        body = self._read_body()
+        with self.s3.lock:
+            if self.headers.get("If-None-Match") == "*" and (bucket, key) in self.s3.objects:
+                self.s3.stats["put_conflicts"] += 1
+                conflict = True
+            else:
+                self.s3.objects[(bucket, key)] = body
+                self.s3.stats["put"] += 1
+                self.s3.stats["put_bytes"] += len(body)
+                conflict = False
+        if conflict:
+            return self._error(412, "PreconditionFailed", "At least one of the pre-conditions you specified did not hold")
+        self._send(200, headers={"ETag": f"\"{len(body)}\""})
+
+    def do_GET(self):
+        if self.path == "/_stats":
+            import json
+            return self._send(200, json.dumps(self.s3.snapshot()).encode("utf-8"), "application/json")
+        bucket, key, query = self._split()
+        if not key and "list-type" in query:
+            return self._list(bucket, query)
+        with self.s3.lock:
+            body = self.s3.objects.get((bucket, key))
+            if body is not None:
+                self.s3.stats["get"] += 1
+                self.s3.stats["get_bytes"] += len(body)
+        if body is None:
+            return self._error(404, "NoSuchKey", "The specified key does not exist.")
+        self._send(200, body, "application/octet-stream", {"ETag": f"\"{len(body)}\""})
+
+    do_HEAD = do_GET
+
+    def _list(self, bucket, query):
+        prefix = query.get("prefix", [""])[0]
+        start_after = query.get("continuation-token", query.get("start-after", [""]))[0]
+        max_keys = int(query.get("max-keys", ["1000"])[0])
+        with self.s3.lock:
+            self.s3.stats["list"] += 1
+            keys = sorted(k for b, k in self.s3.objects if b == bucket and k.startswith(prefix) and k > start_after)
+        page, truncated = keys[:max_keys], len(keys) > max_keys
+        contents = "".join(f"<Contents><Key>{escape(k)}</Key><Size>0</Size></Contents>" for k in page)
+        next_token = f"<NextContinuationToken>{escape(page[-1])}</NextContinuationToken>" if truncated else ""
+        body = (f"<?xml version=\"1.0\" encoding=\"UTF-8\"?><ListBucketResult><Name>{escape(bucket)}</Name>"
+                f"<Prefix>{escape(prefix)}</Prefix><KeyCount>{len(page)}</KeyCount><MaxKeys>{max_keys}</MaxKeys>"
+                f"<IsTruncated>{'true' if truncated else 'false'}</IsTruncated>{next_token}{contents}</ListBucketResult>")
+        self._send(200, body.encode("utf-8"))
+
+    def do_POST(self):
+        bucket, _, query = self._split()
+        body = self._read_body()
+        if "delete" not in query:
+            return self._error(501, "NotImplemented", "Only DeleteObjects is supported")
+        root = ET.fromstring(body)
+        keys = [el.text for el in root.iter() if el.tag.endswith("Key")]
+        with self.s3.lock:
+            for key in keys:
+                self.s3.objects.pop((bucket, key), None)
+            self.s3.stats["delete"] += len(keys)
+        self._send(200, b"<?xml version=\"1.0\" encoding=\"UTF-8\"?><DeleteResult></DeleteResult>")
+
+
+# 例: python bench/fake_s3.py 9000
+if __name__ == "__main__":
+    import sys
+    s3 = FakeS3(port=int(sys.argv[1]) if len(sys.argv) > 1 else 9000)
+    print(f"Fake S3 listening on {s3.url}")
+    s3.server.serve_forever()
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import argparse
+import threading
+import subprocess
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from fake_line import FakeLine, sign, sample_jpeg
+from fake_s3 import FakeS3
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHANNEL_SECRET = "bench-secret"
+BUCKET = "bench"
+
+# ==== プレイヤーの行動（start から第5問まで） ====
+# ("text", 送る文字列) / ("image", None)。画像はジャッジが判定するまで次に進まない
+SCRIPT = [
+    ("text", "start"),
+    ("text", "たんてい"),
+    ("image", None),
+    ("text", "じこし"),
+    ("text", "Dさん"),
+    ("image", None),
+]
+# ジャッジが下す判定（問題番号ごと）
+VERDICTS = {1: "correct", 4: "good_end"}
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# ==== 計測結果 ====
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.webhook = []        # /callback の応答時間
+        self.reply = []          # webhook 送信から返信が LINE に届くまで
+        self.judge_wait = []     # 回答が判定待ちに入ってから判定されるまで
+        self.judge_post = []     # /judge への POST の応答時間
+        self.counts = defaultdict(int)
+
+    def add(self, name, value):
+        with self.lock:
+            getattr(self, name).append(value)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+
+# ==== アプリを別プロセスで起動する ====
+def start_app(args, port, line, s3):
+    env = dict(os.environ)
+    env.update({
+        "LINE_CHANNEL_ACCESS_TOKEN": "bench-token",
+        "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+        "LINE_API_ENDPOINT": line.url,
+        "LINE_API_DATA_ENDPOINT": line.url,
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "AWS_S3_BUCKET_NAME": BUCKET,
+        "AWS_S3_ENDPOINT_URL": s3.url,
+        "STATE_BACKEND": "s3",
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    if args.gunicorn:
+        # スレッド数などは指定がなければ gunicorn.conf.py（本番と同じ設定）に任せる
+        command = [sys.executable, "-m", "gunicorn", "-w", str(args.workers), "-b", f"127.0.0.1:{port}", "app:app"]
+        if args.threads:
+            command[3:3] = ["--threads", str(args.threads)]
+    else:
+        command = [sys.executable, "-c", f"import app; app.app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    log = open(args.app_log, "w") if args.app_log else subprocess.DEVNULL
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    base = f"http://127.0.0.1:{port}"
+    started = time.time()
+    while time.time() - started < 60:
+        if process.poll() is not None:
+            raise RuntimeError(f"App exited with code {process.returncode}")
+        try:
+            if requests.get(f"{base}/status", timeout=1).status_code == 200:
+                return process, base, time.time() - started
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("App did not start within 60 seconds")
+
+
+# ==== webhook を送る ====
+def webhook_event(user_id, n, kind, text):
+    message = {"type": "text", "id": str(n), "text": text, "quoteToken": "bench"} if kind == "text" \
+        else {"type": "image", "id": str(n), "contentProvider": {"type": "line"}, "quoteToken": "bench"}
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "webhookEventId": uuid.uuid4().hex,
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": f"{user_id}:{n}",
+        "message": message,
+    }
+
+
+def post_webhook(session, base, events, results):
+    body = json.dumps({"destination": "bench", "events": events}).encode("utf-8")
+    started = time.time()
+    response = session.post(f"{base}/callback", data=body, headers={
+        "Content-Type": "application/json", "X-Line-Signature": sign(CHANNEL_SECRET, body)})
+    results.add("webhook", time.time() - started)
+    results.count("events", len(events))
+    results.count(f"webhook_{response.status_code}")
+    return started, response.status_code
+
+
+# ==== プレイヤー1人分 ====
+def play(args, base, line, verdicts, results):
+    user_id = "U" + uuid.uuid4().hex
+    verdicts[user_id] = threading.Event()
+    session = requests.Session()
+    for n, (kind, text) in enumerate(SCRIPT):
+        sent, status = post_webhook(session, base, [webhook_event(user_id, n, kind, text)], results)
+        if status != 200:
+            results.count("players_failed")
+            return
+        replied = line.wait_reply(f"{user_id}:{n}", args.timeout)
+        if replied is None:
+            results.count("reply_timeouts")
+            results.count("players_failed")
+            return
+        results.add("reply", replied - sent)
+        if kind == "image":
+            if not verdicts[user_id].wait(args.timeout):
+                results.count("judge_timeouts")
+                results.count("players_failed")
+                return
+            verdicts[user_id].clear()
+        time.sleep(random.uniform(0, args.think))
+    results.count("players_completed")
+
+
+# ==== ジャッジ1人分（判定フィードをロングポーリングし、画面と同じく確保してから判定する） ====
+def judge(args, base, verdicts, results, stop):
+    session = requests.Session()
+    judge_id = "bench-judge-" + uuid.uuid4().hex[:8]
+    seq = 0
+    pending = {}
+    claims = {}   # 他のジャッジの確保 {token: 期限}
+    while not stop.is_set():
+        try:
+            response = session.get(f"{base}/judge/feed", params={"since": seq, "wait": 2})
+        except requests.RequestException:
+            time.sleep(0.5)
+            continue
+        if response.status_code == 200:
+            data = response.json()
+            seq = data["seq"]
+            if data.get("reset"):
+                pending = {item["token"]: item for item in data["pending"]}
+                claims = {token: until for token, (owner, until) in data.get("claims", {}).items() if owner != judge_id}
+            for change in data.get("changes", []):
+                if change["type"] == "pending_add":
+                    pending[change["item"]["token"]] = change["item"]
+                elif change["type"] == "pending_remove":
+                    pending.pop(change["token"], None)
+                elif change["type"] == "claim" and change["judge_id"] != judge_id:
+                    claims[change["token"]] = change["until"]
+        items = [item for item in pending.values() if claims.get(item["token"], 0) <= time.time()]
+        random.shuffle(items)
+        for item in items:
+            if stop.is_set():
+                break
+            try:
+                claimed = session.post(f"{base}/judge/claim", json={"judge_id": judge_id, "claim": [item["token"]]}).json()
+            except (requests.RequestException, ValueError):
+                results.count("judge_errors")
+                continue
+            if not claimed.get("claimed"):
+                # 他のジャッジが先に開いた（判定の手間は無駄にならない）。期限が切れるまで飛ばす
+                claims[item["token"]] = time.time() + claimed.get("lease_seconds", 0)
+                results.count("claims_denied")
+                continue
+            time.sleep(args.judge_delay)
+            started = time.time()
+            try:
+                response = session.post(f"{base}/judge", headers={"Accept": "application/json"}, data={
+                    "user_id": item["user_id"], "qnum": item["qnum"], "token": item["token"],
+                    "result": VERDICTS.get(item["qnum"], "correct"), "judge_id": judge_id})
+            except requests.RequestException:
+                results.count("judge_errors")
+                continue
+            results.add("judge_post", time.time() - started)
+            pending.pop(item["token"], None)
+            if response.status_code == 200:
+                results.count("verdicts")
+                if "received_at" in item:
+                    results.add("judge_wait", time.time() - item["received_at"])
+                event = verdicts.get(item["user_id"])
+                if event is not None:
+                    event.set()
+            else:
+                # 他のジャッジと同じ回答を取り合った
+                results.count("judge_collisions")
+
+
+def run(args):
+    content = sample_jpeg(os.path.join(ROOT, args.image) if args.image else None)
+    line = FakeLine(latency=args.line_latency, content=content).start()
+    s3 = FakeS3().start()
+    process, base, startup = start_app(args, free_port(), line, s3)
+    s3_before = s3.snapshot()
+    results = Results()
+    verdicts = {}
+    stop = threading.Event()
+    judges = [threading.Thread(target=judge, args=(args, base, verdicts, results, stop), daemon=True)
+              for _ in range(args.judges)]
+    for t in judges:
+        t.start()
+
+    started = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=args.players) as pool:
+            for i in range(args.players):
+                pool.submit(play, args, base, line, verdicts, results)
+                time.sleep(args.ramp / max(1, args.players))
+        elapsed = time.time() - started
+        stop.set()
+        for t in judges:
+            t.join(10)
+        status = requests.get(f"{base}/status", timeout=5).json()
+    finally:
+        stop.set()
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    s3_after = s3.snapshot()
+    events = results.counts["events"]
+    bytes_written = s3_after["put_bytes"] - s3_before["put_bytes"]
+    report = {
+        "players": args.players,
+        "players_completed": results.counts["players_completed"],
+        "players_failed": results.counts["players_failed"],
+        "startup_seconds": round(startup, 2),
+        "elapsed_seconds": round(elapsed, 2),
+        "events": events,
+        "events_per_second": round(events / elapsed, 1) if elapsed else 0,
+        "webhook_ms": {"p50": round(percentile(results.webhook, 50) * 1000, 1),
+                       "p99": round(percentile(results.webhook, 99) * 1000, 1)},
+        # 同じプレイヤー宛ての配信は順番に送るので、前のストーリーが残っていると返信もその後になる
+        "reply_ms": {"p50": round(percentile(results.reply, 50) * 1000, 1),
+                     "p99": round(percentile(results.reply, 99) * 1000, 1)},
+        "judge": {"verdicts": results.counts["verdicts"], "collisions": results.counts["judge_collisions"],
+                  "claims_denied": results.counts["claims_denied"],
+                  "wait_p50_seconds": round(percentile(results.judge_wait, 50), 2),
+                  "wait_p99_seconds": round(percentile(results.judge_wait, 99), 2),
+                  "post_p99_ms": round(percentile(results.judge_post, 99) * 1000, 1)},
+        "s3": {"puts": s3_after["put"] - s3_before["put"], "bytes_written": bytes_written,
+               "bytes_per_event": round(bytes_written / events) if events else 0,
+               "conflicts": s3_after["put_conflicts"] - s3_before["put_conflicts"]},
+        "line": line.snapshot(),
+        "queues": {"event_wait_max_seconds": status["events"]["max_wait_seconds"],
+                   "event_rejected": status["events"]["rejected"],
+                   "delivery_lag_max_seconds": status["delivery"]["max_lag_seconds"],
+                   "state_writes": status.get("state_writes")},
+        "timeouts": {"reply": results.counts["reply_timeouts"], "judge": results.counts["judge_timeouts"]},
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the bot against local fake LINE and S3 servers.")
+    parser.add_argument("--players", type=int, default=50, help="number of concurrent players")
+    parser.add_argument("--judges", type=int, default=2, help="number of judges clicking on /judge")
+    parser.add_argument("--ramp", type=float, default=5.0, help="seconds over which players join")
+    parser.add_argument("--think", type=float, default=0.5, help="max seconds a player waits between messages")
+    parser.add_argument("--judge-delay", type=float, default=0.2, help="seconds a judge spends per answer")
+    parser.add_argument("--line-latency", type=float, default=0.05, help="fake LINE API latency in seconds")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for a reply or verdict")
+    parser.add_argument("--image", default="static/office.jpg", help="image players send (relative to repo)")
+    parser.add_argument("--gunicorn", action="store_true", help="run the app with gunicorn instead of the dev server")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, help="gunicorn threads per worker (default: gunicorn.conf.py)")
+    parser.add_argument("--env", action="append", default=[], help="extra KEY=VALUE for the app (repeatable)")
+    parser.add_argument("--app-log", help="write the app's output to this file")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    report = run(args)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+# 例: python bench/load.py --players 100 --judges 3 --gunicorn --workers 2
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import uuid
+import heapq
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# ==== 配信ジョブの保存キー ====
+DELIVERY_PREFIX = "delivery/"
+CLAIM_PREFIX = "delivery-claims/"
+
+DELIVERY_WORKERS = int(os.environ.get("DELIVERY_WORKERS", "8"))
+# この秒数進んでいないジョブは持ち主のプロセスが落ちたとみなして引き継ぐ
+DELIVERY_STALE_SECONDS = int(os.environ.get("DELIVERY_STALE_SECONDS", "120"))
+DELIVERY_SWEEP_SECONDS = int(os.environ.get("DELIVERY_SWEEP_SECONDS", "60"))
+
+
+def _job_key(job_id):
+    return f"{DELIVERY_PREFIX}{job_id}.json"
+
+
+# LINEは1回のreply/pushで5件までメッセージを送れる
+MAX_MESSAGES_PER_CALL = 5
+# これ未満の待ち時間は区切りにせず、次のメッセージと同じ呼び出しにまとめる
+BATCH_MIN_PAUSE = int(os.environ.get("LINE_BATCH_MIN_PAUSE", "2"))
+
+
+# ==== メッセージのまとめ送り ====
+# entries = [(message, delay_seconds), ...]
+# 待ち時間が BATCH_MIN_PAUSE 以上のところと5件ごとでだけ区切る
+def pack_steps(entries):
+    steps = []
+    current = []
+    for message, delay in entries:
+        current.append(message)
+        if delay >= BATCH_MIN_PAUSE or len(current) == MAX_MESSAGES_PER_CALL:
+            steps.append({"messages": current, "delay": delay + 1})
+            current = []
+    if current:
+        steps.append({"messages": current, "delay": 0})
+    return steps
+
+
+# ==== ストーリー配信スケジューラ ====
+# ジョブ = (user_id, [{"messages": [...], "delay": 秒}, ...])
+# reply_token があれば最初のステップは reply で送る（無料・1往復少ない）
+# 同じユーザーのステップは必ず順番に、前のステップの delay 経過後に送る。
+# 別ユーザー同士はワーカースレッドで並列に送る。
+# ジョブはバックエンドに保存しておき、持ち主のプロセスが落ちたら別のプロセスが途中から再開する。
+# 引き継ぎは「存在しなければ作成」の書き込みで1プロセスだけが行う。
+class DeliveryScheduler:
+    def __init__(self, send, backend=None, on_error=None, workers=DELIVERY_WORKERS):
+        self._send = send            # send(user_id, messages, reply_token, retry_key)
+        self._on_error = on_error    # on_error(user_id, exception)
+        self._backend = backend
+        self._workers = workers
+        self._cond = threading.Condition()
+        self._heap = []              # [(due, seq, user_id)]
+        self._counter = 0
+        self._queues = {}            # {user_id: deque([job, ...])}
+        self._pid = None
+        self._owner = None           # このプロセスの識別子
+        self._pool = None
+        self._stopped = False
+        self._last_lag = 0.0
+        self._max_lag = 0.0
+        self._sent_steps = 0
+        self._failed_jobs = 0
+
+    # ---- スレッド起動（fork後のプロセスでも動くように pid で判定） ----
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._owner = uuid.uuid4().hex
+        self._pool = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="delivery")
+        threading.Thread(target=self._dispatch_loop, name="delivery-dispatcher", daemon=True).start()
+        if self._backend is not None:
+            threading.Thread(target=self._sweep_loop, name="delivery-sweeper", daemon=True).start()
+
+    def _schedule(self, user_id, due):
+        self._counter += 1
+        heapq.heappush(self._heap, (due, self._counter, user_id))
+        self._cond.notify()
+
+    def _persist(self, job):
+        if self._backend is None:
+            return
+        # 止めたプロセスのジョブは、他のプロセスが待たずに引き継げるよう更新時刻を0にしておく
+        job["updated"] = 0 if self._stopped else time.time()
+        try:
+            self._backend.put(_job_key(job["id"]), json.dumps(job, ensure_ascii=False).encode('utf-8'))
+        except Exception as e:
+            print(f"Failed to persist delivery job {job['id']}: {str(e)}")
+
+    def _forget(self, job):
+        if self._backend is None:
+            return
+        try:
+            self._backend.delete([_job_key(job["id"])] + job.get("claims", []))
+        except Exception as e:
+            print(f"Failed to delete delivery job {job['id']}: {str(e)}")
+
+    def _enqueue(self, job):
+        with self._cond:
+            self._ensure_started()
+            queue = self._queues.get(job["user_id"])
+            if queue:
+                queue.append(job)
+            else:
+                self._queues[job["user_id"]] = deque([job])
+                self._schedule(job["user_id"], time.time())
+
+    def submit(self, user_id, steps, reply_token=None):
+        steps = [s for s in steps if s["messages"]]
+        if not steps:
+            return None
+        with self._cond:
+            self._ensure_started()
+        job = {"id": uuid.uuid4().hex, "user_id": user_id, "steps": steps, "step": 0,
+               "reply_token": reply_token, "owner": self._owner, "created": time.time()}
+        self._persist(job)
+        self._enqueue(job)
+        return job["id"]
+
+    # ---- 持ち主が止まったジョブを引き継ぐ ----
+    def restore(self):
+        if self._backend is None or self._stopped:
+            return 0
+        with self._cond:
+            self._ensure_started()
+        stale_before = time.time() - DELIVERY_STALE_SECONDS
+        jobs = []
+        for key in self._backend.list(DELIVERY_PREFIX):
+            raw = self._backend.get(key)
+            if raw is None:
+                continue
+            job = json.loads(raw.decode('utf-8'))
+            if job.get("owner") == self._owner or job.get("updated", job["created"]) > stale_before:
+                continue
+            claim_key = f"{CLAIM_PREFIX}{job['id']}.{job.get('owner')}"
+            if not self._backend.put_if_absent(claim_key, self._owner.encode('utf-8')):
+                continue  # 他のプロセスが先に引き継いだ
+            job["owner"] = self._owner
+            job["claims"] = job.get("claims", []) + [claim_key]
+            jobs.append(job)
+        jobs.sort(key=lambda j: j["created"])
+        for job in jobs:
+            self._persist(job)
+            self._enqueue(job)
+        if jobs:
+            print(f"Restored {len(jobs)} pending delivery jobs.")
+        return len(jobs)
+
+    def _sweep_loop(self):
+        while not self._stopped:
+            time.sleep(DELIVERY_SWEEP_SECONDS)
+            try:
+                self.restore()
+            except Exception as e:
+                print(f"Delivery sweep failed: {str(e)}")
+
+    # ---- 停止（プロセスの終了時） ----
+    # 新しいステップを渡すのをやめ、まだ始まっていないステップは取り消す。
+    # 送っている最中のステップは待たない（送り直しても retry_key で二重には届かない）。
+    # 残ったジョブはバックエンドに残し、他のプロセスの restore() ですぐ引き継げるようにする
+    def stop(self):
+        with self._cond:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._cond.notify_all()
+            if self._pid == os.getpid() and self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+            jobs = [job for queue in self._queues.values() for job in queue]
+        for job in jobs:
+            self._persist(job)
+        if jobs:
+            print(f"Delivery stopped with {len(jobs)} jobs left for other processes.")
+
+    # ---- タイマー: 期限が来たユーザーの次のステップをワーカーに渡す ----
+    def _dispatch_loop(self):
+        with self._cond:
+            while not self._stopped:
+                if not self._heap or self._heap[0][0] > time.time():
+                    self._cond.wait(self._heap[0][0] - time.time() if self._heap else None)
+                    continue
+                due, _, user_id = heapq.heappop(self._heap)
+                self._last_lag = max(0.0, time.time() - due)
+                self._max_lag = max(self._max_lag, self._last_lag)
+                try:
+                    self._pool.submit(self._run_step, user_id)
+                except RuntimeError:
+                    # インタープリタの終了でプールが止まった。ジョブは保存済みなので他のプロセスが引き継ぐ
+                    return
+
+    def _run_step(self, user_id):
+        with self._cond:
+            job = self._queues[user_id][0]
+            step = job["steps"][job["step"]]
+            reply_token = job.pop("reply_token", None) if job["step"] == 0 else None
+            # 同じステップを送り直したときに二重に届かないよう、ステップごとに決まったキーにする
+            retry_key = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{DELIVERY_PREFIX}{job['id']}/{job['step']}"))
+        try:
+            self._send(user_id, step["messages"], reply_token, retry_key)
+            failed = None
+        except Exception as e:
+            failed = e
+
+        with self._cond:
+            if failed is None:
+                self._sent_steps += 1
+                job["step"] += 1
+                finished = job["step"] >= len(job["steps"])
+            else:
+                self._failed_jobs += 1
+                finished = True
+            if finished:
+                self._queues[user_id].popleft()
+                if not self._queues[user_id]:
+                    del self._queues[user_id]
+            if user_id in self._queues:
+                self._schedule(user_id, time.time() + step.get("delay", 0))
+
+        if finished:
+            self._forget(job)
+        else:
+            self._persist(job)
+        if failed is not None:
+            print(f"Delivery to {user_id} failed at step {job['step']}: {str(failed)}")
+            if self._on_error:
+                try:
+                    self._on_error(user_id, failed)
+                except Exception as e:
+                    print(f"Delivery error handler failed for {user_id}: {str(e)}")
+
+    # ---- キューの深さと遅延 ----
+    def stats(self):
+        with self._cond:
+            jobs = sum(len(q) for q in self._queues.values())
+            steps = sum(len(j["steps"]) - j["step"] for q in self._queues.values() for j in q)
+            return {
+                "users": len(self._queues),
+                "jobs": jobs,
+                "steps_pending": steps,
+                "steps_sent": self._sent_steps,
+                "jobs_failed": self._failed_jobs,
+                "lag_seconds": round(self._last_lag, 3),
+                "max_lag_seconds": round(self._max_lag, 3),
+            }
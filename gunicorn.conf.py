@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+
+# ==== gunicorn の設定（gunicorn app:app で自動的に読み込まれる） ====
+# 起動時刻（最初のリクエストまでの時間の計測に使う）
+os.environ.setdefault("APP_STARTED_AT", str(time.time()))
+
+# アプリと状態を親プロセスで1回だけ読み込み、ワーカーは fork で引き継ぐ
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+if preload_app:
+    # 親プロセスでは裏のスレッドを起こさない（fork 時に止まってしまうため）。ワーカーの post_fork で起こす
+    os.environ["APP_PRELOAD"] = "1"
+
+# 判定画面のロングポーリング・ストリームが待っている間も webhook を受けられるよう、スレッドで処理する
+# （同期ワーカーだと1本のロングポーリングでそのワーカー全体が止まる）
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+# そのうち判定フィードで待たせてよいのは半分まで（残りは webhook などのため）
+os.environ.setdefault("FEED_MAX_WAITERS", str(max(1, threads // 2)))
+
+forked_workers = 0
+
+
+def pre_fork(server, worker):
+    global forked_workers
+    forked_workers += 1
+
+
+# preload のときは app がすでに読み込まれている（なければワーカー側の読み込み時にスレッドが起きる）
+def post_fork(server, worker):
+    # 同じユーザーのイベントが別々のワーカーに届くので、ワーカー間で担当を決める（app.acquire_user）
+    os.environ["APP_MULTI_WORKER"] = "1" if server.num_workers > 1 else "0"
+    app = sys.modules.get("app")
+    if app is None:
+        return
+    app.multi_worker = server.num_workers > 1
+    # 入れ替わりで後から起動したワーカーは、fork した時点から最初のリクエストまでを測る
+    if forked_workers > server.num_workers:
+        app.startup["started_at"] = time.time()
+    app.start_state_catch_up()
+
+
+def worker_exit(server, worker):
+    app = sys.modules.get("app")
+    if app is not None:
+        app.flush_state()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import threading
+from collections import OrderedDict
+
+# ==== 判定履歴アーカイブの設定 ====
+HISTORY_PREFIX = "history/"
+HISTORY_SEGMENT_SIZE = int(os.environ.get("HISTORY_SEGMENT_SIZE", "100"))
+HISTORY_CACHE_SEGMENTS = 8  # 読み込んだセグメントを何個までメモリに置くか
+HISTORY_UNWRITTEN_SEGMENTS = 8  # まだ保存を確かめていないセグメントを何個までメモリに残すか
+
+
+def _segment_key(first):
+    return f"{HISTORY_PREFIX}segment-{first:010d}.json"
+
+
+# ==== 判定履歴（追記専用セグメント + メモリ上の末尾） ====
+# 履歴には先頭から通し番号（0, 1, 2, ...）が付く。
+# segment_size 件たまるごとに1つの不変オブジェクトとして保存し、メモリには末尾だけを残す。
+# ページングのカーソルは通し番号（before より前を新しい順に返す）。
+# append（変更の適用・再生）ではメモリ上でセグメントに区切るだけで、保存はしない。
+# 保存は、その変更をジャーナルに書けたワーカーが store() でロックの外から行う（取り消されうる変更は保存しない）。
+class HistoryArchive:
+    def __init__(self, backend=None, segment_size=HISTORY_SEGMENT_SIZE):
+        self._backend = backend
+        self.segment_size = segment_size
+        self._segments = []   # [{"key": str, "first": int, "count": int}]
+        self._tail = []       # まだセグメントにしていない履歴
+        self._sealed = 0      # セグメントに入っている件数
+        self._cache = OrderedDict()  # {key: [entry, ...]}
+        self._unwritten = OrderedDict()  # 区切ったがまだ保存していないセグメント {key: [entry, ...]}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self._sealed + len(self._tail)
+
+    def __iter__(self):
+        return iter(list(self._tail))
+
+    def append(self, entry):
+        with self._lock:
+            self._tail.append(entry)
+            if len(self._tail) >= self.segment_size:
+                self._seal()
+
+    # 最後に追加した1件を取り消す（書き込めなかった変更を取り消すときに使う）。
+    # セグメントにした直後なら末尾に戻す（書けていない変更のセグメントは保存していない）
+    def pop(self):
+        with self._lock:
+            if not self._tail and self._segments:
+                segment = self._segments.pop()
+                entries = self._unwritten.pop(segment["key"], None)
+                self._tail = list(entries if entries is not None else self._load_segment(segment))
+                self._sealed -= segment["count"]
+            return self._tail.pop() if self._tail else None
+
+    def _seal(self):
+        if self._backend is None:
+            return
+        entries = self._tail[:self.segment_size]
+        key = _segment_key(self._sealed)
+        self._segments.append({"key": key, "first": self._sealed, "count": len(entries)})
+        self._unwritten[key] = entries
+        self._sealed += len(entries)
+        self._tail = self._tail[len(entries):]
+        # 他のワーカーが書いた分（再生で区切ったもの）はそのワーカーが保存するので、古いものから普通のキャッシュに回す
+        while len(self._unwritten) > HISTORY_UNWRITTEN_SEGMENTS:
+            self._remember(*self._unwritten.popitem(last=False))
+
+    # ---- 保存 ----
+    # 通し番号 start より後・end まで（end 件目を含む）の範囲で区切られた、まだ保存していないセグメント
+    def unwritten(self, start=0, end=None):
+        with self._lock:
+            end = len(self) if end is None else end
+            return [(segment["key"], self._unwritten[segment["key"]]) for segment in self._segments
+                    if segment["key"] in self._unwritten and start < segment["first"] + segment["count"] <= end]
+
+    # 内容は通し番号で決まるので、すでにあれば書かない（他のワーカーが読んでいるものを書き換えない）
+    def store(self, segments):
+        for key, entries in segments:
+            self._backend.put_if_absent(key, json.dumps(entries, ensure_ascii=False).encode('utf-8'))
+        with self._lock:
+            for key, entries in segments:
+                if self._unwritten.pop(key, None) is not None:
+                    self._remember(key, entries)
+
+    def _remember(self, key, entries):
+        self._cache[key] = entries
+        self._cache.move_to_end(key)
+        while len(self._cache) > HISTORY_CACHE_SEGMENTS:
+            self._cache.popitem(last=False)
+
+    def _load_segment(self, segment):
+        entries = self._unwritten.get(segment["key"])
+        if entries is not None:
+            return entries
+        entries = self._cache.get(segment["key"])
+        if entries is None:
+            raw = self._backend.get(segment["key"])
+            entries = json.loads(raw.decode('utf-8')) if raw is not None else []
+        self._remember(segment["key"], entries)
+        return entries
+
+    # ---- ページング: before より前の limit 件を新しい順に返す ----
+    def page(self, before=None, limit=20):
+        with self._lock:
+            total = len(self)
+            before = total if before is None else max(0, min(before, total))
+            start = max(0, before - limit)
+            items = []
+            for segment in self._segments:
+                seg_end = segment["first"] + segment["count"]
+                if seg_end <= start or segment["first"] >= before:
+                    continue
+                entries = self._load_segment(segment)
+                items.extend(entries[max(start, segment["first"]) - segment["first"]:min(before, seg_end) - segment["first"]])
+            if before > self._sealed:
+                items.extend(self._tail[max(0, start - self._sealed):before - self._sealed])
+            items.reverse()
+            return items, (start if start > 0 else None)
+
+    # ---- 保存形式: セグメントの索引と末尾だけ ----
+    def to_dict(self):
+        with self._lock:
+            return {"segments": list(self._segments), "tail": list(self._tail), "sealed": self._sealed}
+
+    def reset(self, data):
+        with self._lock:
+            self._segments = []
+            self._tail = []
+            self._sealed = 0
+            self._cache.clear()
+            self._unwritten.clear()
+            # 旧形式（履歴全件のリスト）はセグメントに切り出して移行する
+            if isinstance(data, list):
+                for entry in data:
+                    self.append(entry)
+                return
+            self._segments = list(data.get("segments", []))
+            self._sealed = data.get("sealed", sum(s["count"] for s in self._segments))
+            self._tail = list(data.get("tail", []))
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import sys
+import json
+import hashlib
+from PIL import Image, ImageOps
+
+# ==== 派生画像の設定 ====
+# LINEのプレビュー画像は小さく表示されるだけなので、長辺を抑えて軽くする
+PREVIEW_MAX_SIDE = int(os.environ.get("PREVIEW_MAX_SIDE", "240"))
+# 判定画面のカード用
+THUMB_MAX_SIDE = int(os.environ.get("THUMB_MAX_SIDE", "640"))
+DERIVED_QUALITY = int(os.environ.get("DERIVED_QUALITY", "80"))
+
+DERIVED_SIZES = {"preview": PREVIEW_MAX_SIDE, "thumb": THUMB_MAX_SIDE}
+DERIVED_DIR = "derived"
+MANIFEST_NAME = "manifest.json"
+
+# 派生画像の名前には内容のハッシュが入るので、ずっとキャッシュさせてよい
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+# ==== 縮小してJPEGにする ====
+def derive_image(source, max_side, quality=DERIVED_QUALITY):
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+        return out.getvalue()
+
+
+# ==== static/ の画像から派生画像と対応表を作る（ビルド時に実行） ====
+# static/derived/{名前}.{種類}.{ハッシュ}.jpg と static/derived/manifest.json を書く
+#   {"osada1.jpg": {"preview": "derived/osada1.preview.1a2b3c4d.jpg", "thumb": "..."}}
+def build_static(static_dir):
+    derived_dir = os.path.join(static_dir, DERIVED_DIR)
+    os.makedirs(derived_dir, exist_ok=True)
+    manifest = {}
+    for name in sorted(os.listdir(static_dir)):
+        if not name.lower().endswith((".jpg", ".jpeg", ".png")):
+            continue
+        stem = os.path.splitext(name)[0]
+        manifest[name] = {}
+        for kind, max_side in DERIVED_SIZES.items():
+            data = derive_image(os.path.join(static_dir, name), max_side)
+            digest = hashlib.sha256(data).hexdigest()[:8]
+            derived_name = f"{stem}.{kind}.{digest}.jpg"
+            path = os.path.join(derived_dir, derived_name)
+            if not os.path.exists(path):
+                _write_atomic(path, data)
+            manifest[name][kind] = f"{DERIVED_DIR}/{derived_name}"
+        print(f"Derived {name}: {manifest[name]}")
+
+    # 対応表にない古い派生画像は消す
+    keep = {os.path.basename(p) for kinds in manifest.values() for p in kinds.values()}
+    for name in os.listdir(derived_dir):
+        if name != MANIFEST_NAME and name not in keep and not name.endswith(".tmp"):
+            os.remove(os.path.join(derived_dir, name))
+
+    _write_atomic(os.path.join(derived_dir, MANIFEST_NAME), json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8"))
+    return manifest
+
+
+# 複数のワーカーが同時に作っても、読み手が書きかけのファイルを見ないように
+def _write_atomic(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def load_manifest(static_dir):
+    try:
+        with open(os.path.join(static_dir, DERIVED_DIR, MANIFEST_NAME), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        print("Derived image manifest not found; serving original images.")
+        return {}
+    except Exception as e:
+        print(f"Failed to load derived image manifest: {str(e)}")
+        return {}
+
+
+# 例: python image_derive.py static
+if __name__ == "__main__":
+    build_static(sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"))
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import numpy as np
+from PIL import Image, ImageOps
+
+# ==== 類似画像の判定設定 ====
+# off: 使わない / label: 判定候補として表示し先頭に並べる / auto: 同じ判定を自動で下す
+IMAGE_MATCH_MODE = os.environ.get("IMAGE_MATCH_MODE", "label")
+# 64ビットのハッシュで何ビットまでの違いを「同じ画像」とみなすか
+IMAGE_MATCH_DISTANCE = int(os.environ.get("IMAGE_MATCH_DISTANCE", "6"))
+# 照合に使う判定済み画像の件数（新しい方から）
+IMAGE_MATCH_LIMIT = int(os.environ.get("IMAGE_MATCH_LIMIT", "5000"))
+
+HASH_SIZE = 8
+
+
+# ==== 差分ハッシュ（dHash） ====
+# 縮小したグレースケール画像で、横に隣り合う画素の明暗の向きを64ビットにする。
+# 撮り直しや圧縮の違いでは数ビットしか変わらない。
+def dhash(source, hash_size=HASH_SIZE):
+    if hasattr(source, "seek"):
+        source.seek(0)
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image).convert("L")
+        image = image.resize((hash_size + 1, hash_size), Image.LANCZOS)
+        pixels = np.asarray(image, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def format_hash(value):
+    return f"{value:016x}"
+
+
+def _popcount(values):
+    return np.unpackbits(values.view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+
+# ==== 判定済み画像のハッシュ索引 ====
+# 問題ごとに判定済み画像のハッシュを新しい方から limit 件まで持ち、ハミング距離で照合する。
+# 人が下した判定だけを登録する（自動判定を元に自動判定が連鎖しないように）。
+class ImageHashIndex:
+    def __init__(self, history, limit=IMAGE_MATCH_LIMIT):
+        self._history = history   # HistoryArchive（読み直し時は前回から増えた分だけ読む）
+        self._limit = limit
+        self._by_question = {}    # {qnum: {"hashes": np.ndarray(uint64), "entries": [(result, token), ...]}}
+        self._tokens = set()
+        self._indexed = 0         # 索引に取り込んだ履歴の件数
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def _add(self, entry):
+        token = entry.get("token")
+        if not entry.get("phash") or entry.get("auto_from") or token in self._tokens:
+            return
+        bucket = self._by_question.setdefault(entry["qnum"], {"hashes": np.zeros(0, dtype=np.uint64), "entries": []})
+        bucket["hashes"] = np.append(bucket["hashes"], np.uint64(int(entry["phash"], 16)))
+        bucket["entries"].append((entry["result"], token))
+        self._tokens.add(token)
+        if len(bucket["entries"]) > self._limit:
+            for _, old in bucket["entries"][:-self._limit]:
+                self._tokens.discard(old)
+            bucket["hashes"] = bucket["hashes"][-self._limit:]
+            bucket["entries"] = bucket["entries"][-self._limit:]
+
+    # StateStore の変更通知から呼ばれる
+    def observe(self, mutation, seq):
+        op = mutation.get("op")
+        if op == "judged":
+            with self._lock:
+                self._add(mutation["entry"])
+        elif op == "reset":
+            self.sync()
+
+    # 前回取り込んだ後に増えた履歴を読み込む（最大 limit 件）
+    def sync(self):
+        total = len(self._history)
+        with self._lock:
+            if total < self._indexed:
+                self._by_question = {}
+                self._tokens = set()
+                self._indexed = 0
+            start = max(self._indexed, total - self._limit)
+        entries = []
+        before = total
+        while before > start:
+            items, _ = self._history.page(before, min(500, before - start))
+            if not items:
+                break
+            entries.extend(items)
+            before -= len(items)
+        with self._lock:
+            for entry in reversed(entries):
+                self._add(entry)
+            self._indexed = total
+
+    # 距離が max_distance 以内で最も近い判定済み画像を返す: {"result", "token", "distance"} か None
+    # 同じ距離なら新しい判定を優先する
+    def match(self, qnum, phash, max_distance=IMAGE_MATCH_DISTANCE):
+        with self._lock:
+            bucket = self._by_question.get(qnum)
+            if bucket is None or not bucket["entries"]:
+                return None
+            distances = _popcount(bucket["hashes"] ^ np.uint64(int(phash, 16)))[::-1]
+            best = int(np.argmin(distances))
+            if distances[best] > max_distance:
+                return None
+            result, token = bucket["entries"][-1 - best]
+            return {"result": result, "token": token, "distance": int(distances[best])}
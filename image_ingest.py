@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from image_derive import derive_image, THUMB_MAX_SIDE, IMMUTABLE_CACHE_CONTROL
+
+# ==== 画像取り込みの設定 ====
+INGEST_CHUNK_SIZE = int(os.environ.get("INGEST_CHUNK_SIZE", str(256 * 1024)))
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", str(20 * 1024 * 1024)))
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "4"))
+# 縮小画像を作るために手元に残す写しは、この大きさを超えたら一時ファイルに逃がす
+INGEST_SPOOL_BYTES = int(os.environ.get("INGEST_SPOOL_BYTES", str(2 * 1024 * 1024)))
+THUMB_PREFIX = "thumbs/"
+
+# マルチパートの1パートを8MBにし、同時に持つバッファを2つまでに抑える
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=2,
+    use_threads=True,
+)
+
+
+class ImageTooLargeError(IOError):
+    pass
+
+
+# ==== LINEのコンテンツ応答をファイルのように読むラッパー ====
+# 全体をメモリに溜めず、読んだ分だけ SHA-256 とサイズを更新する（copy_to があれば写しも書く）
+class ContentStream(io.RawIOBase):
+    def __init__(self, chunks, max_bytes=MAX_IMAGE_BYTES, copy_to=None):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+        self._max_bytes = max_bytes
+        self._copy_to = copy_to
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._buffer = chunk
+        n = min(len(b), len(self._buffer))
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        self.size += n
+        if self.size > self._max_bytes:
+            raise ImageTooLargeError(f"Image exceeds {self._max_bytes} bytes")
+        self.sha256.update(data)
+        if self._copy_to is not None:
+            self._copy_to.write(data)
+        b[:n] = data
+        return n
+
+
+# ==== LINE → S3 のストリーミングアップロード ====
+def stream_to_s3(s3_client, bucket, key, message_content, max_bytes=MAX_IMAGE_BYTES, copy_to=None):
+    stream = ContentStream(message_content.iter_content(chunk_size=INGEST_CHUNK_SIZE), max_bytes, copy_to)
+    s3_client.upload_fileobj(
+        io.BufferedReader(stream, buffer_size=INGEST_CHUNK_SIZE),
+        bucket,
+        key,
+        ExtraArgs={'ACL': 'public-read', 'ContentType': 'image/jpeg', 'ChecksumAlgorithm': 'SHA256'},
+        Config=TRANSFER_CONFIG,
+    )
+    return stream.size, stream.sha256.hexdigest()
+
+
+def spool():
+    return tempfile.SpooledTemporaryFile(max_size=INGEST_SPOOL_BYTES)
+
+
+# ==== 判定画面用の縮小画像を S3 に置く ====
+# キーは回答ごとに一意なので、内容が変わることはなく長期キャッシュできる
+def upload_thumbnail(s3_client, bucket, key, source):
+    source.seek(0)
+    data = derive_image(source, THUMB_MAX_SIDE)
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=data,
+        ACL='public-read',
+        ContentType='image/jpeg',
+        CacheControl=IMMUTABLE_CACHE_CONTROL,
+    )
+    return len(data)
+
+
+# ==== 取り込み用ワーカー（webhookのスレッドを待たせない） ====
+class ImageIngestor:
+    def __init__(self, workers=INGEST_WORKERS):
+        self._workers = workers
+        self._pid = None
+        self._pool = None
+
+    def submit(self, fn, *args):
+        # fork後のプロセスでは作り直す
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pool = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="ingest")
+        return self._pool.submit(fn, *args)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import deque
+
+# 差分を保持しておく件数（これより古い seq から問い合わせが来たら全件を返す）
+FEED_MAX_CHANGES = 1000
+
+
+# ==== 判定画面向けの差分フィード ====
+# 状態ストアに適用された変更を受け取り、ジャーナル番号（全ワーカー共通）を seq として保持する。
+#   {"seq": n, "type": "pending_add", "item": {...}}
+#   {"seq": n, "type": "pending_remove", "token": str}
+#   {"seq": n, "type": "history_add", "item": {...}}
+#   {"seq": n, "type": "claim", "token": str, "judge_id": str, "until": float}（until=0 は開放）
+# seq は判定画面に関係する変更があったときだけ進む。
+class JudgeFeed:
+    def __init__(self, max_changes=FEED_MAX_CHANGES):
+        self.seq = 0
+        self._oldest = 0  # これ以前の差分は捨てている（0 は「すべて保持」）
+        self._changes = deque(maxlen=max_changes)
+        self._cond = threading.Condition()
+
+    def _append(self, seq, change):
+        if len(self._changes) == self._changes.maxlen:
+            self._oldest = self._changes[0]["seq"]
+        change["seq"] = seq
+        self._changes.append(change)
+        self.seq = max(self.seq, seq)
+
+    # StateStore の変更通知から呼ばれる
+    def observe(self, mutation, seq):
+        op = mutation.get("op")
+        with self._cond:
+            if op == "pending_add":
+                self._append(seq, {"type": "pending_add", "item": mutation["entry"]})
+            elif op == "judged":
+                self._append(seq, {"type": "pending_remove", "token": mutation["token"]})
+                self._append(seq, {"type": "history_add", "item": mutation["entry"]})
+            elif op == "claim":
+                self._append(seq, {"type": "claim", "token": mutation["token"], "judge_id": mutation["judge_id"],
+                                   "until": mutation["until"]})
+            elif op == "reset":
+                # 状態を読み直したときは差分を捨て、それより前からのクライアントには全件取得させる
+                self.seq = seq
+                self._oldest = seq
+                self._changes.clear()
+            else:
+                return
+            self._cond.notify_all()
+
+    # seq より後の差分を返す。差分が残っていなければ None（全件取り直し）
+    def since(self, seq):
+        with self._cond:
+            if seq < self._oldest:
+                return None
+            return [c for c in self._changes if c["seq"] > seq]
+
+    # seq より新しい変更が来るまで最大 timeout 秒待つ（ロングポーリング用）
+    def wait(self, seq, timeout):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.seq > seq, timeout)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import queue
+import threading
+from collections import deque
+
+EVENT_WORKERS = int(os.environ.get("EVENT_WORKERS", "8"))
+EVENT_QUEUE_LIMIT = int(os.environ.get("EVENT_QUEUE_LIMIT", "1000"))
+
+
+# ==== キー（ユーザー）ごとに順番を守るワーカープール ====
+# 同じキーの項目は到着順に1つずつ処理し、別のキー同士は並列に処理する。
+# キーは処理待ちがある間だけ ready キューに1回だけ入るので、同じキーが同時に動くことはない。
+# 待ち件数が上限に達したら submit は空きを待ち、待ちきれなければ False を返す（背圧）。
+# 順番を守れるのはこのプロセスの中だけ。プロセスをまたぐ分は呼び出し側で守る（app.py の担当ワーカーを参照）。
+class KeyedWorkerPool:
+    def __init__(self, handle, workers=EVENT_WORKERS, max_pending=EVENT_QUEUE_LIMIT, name="events", on_idle=None):
+        self._handle = handle            # handle(item)
+        self._on_idle = on_idle          # on_idle(key): そのキーの待ちがなくなるとき、次の項目より前に呼ぶ
+        self._workers = workers
+        self._max_pending = max_pending
+        self._name = name
+        self._cond = threading.Condition()
+        self._queues = {}                # {key: deque([(item, enqueued_at), ...])}
+        self._ready = None
+        self._pending = 0
+        self._pid = None
+        self._processed = 0
+        self._rejected = 0
+        self._failed = 0
+        self._last_wait = 0.0
+        self._max_wait = 0.0
+        self._last_run = 0.0
+
+    def _ensure_started(self):
+        # fork後のプロセスではスレッドを作り直す
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._ready = queue.Queue()
+        for key in self._queues:
+            self._ready.put(key)
+        for i in range(self._workers):
+            threading.Thread(target=self._work, name=f"{self._name}-{i}", daemon=True).start()
+
+    # items = [(key, item), ...] をまとめて受け付ける（全部入るか、1つも入らないか）
+    def submit_many(self, items, timeout=5.0):
+        with self._cond:
+            self._ensure_started()
+            if not self._cond.wait_for(lambda: self._pending + len(items) <= self._max_pending, timeout):
+                self._rejected += len(items)
+                return False
+            now = time.time()
+            for key, item in items:
+                q = self._queues.get(key)
+                if q is None:
+                    self._queues[key] = deque([(item, now)])
+                    self._ready.put(key)
+                else:
+                    q.append((item, now))
+                self._pending += 1
+            return True
+
+    def submit(self, key, item, timeout=5.0):
+        return self.submit_many([(key, item)], timeout)
+
+    def _work(self):
+        ready = self._ready
+        while True:
+            key = ready.get()
+            with self._cond:
+                item, enqueued_at = self._queues[key][0]
+            started = time.time()
+            try:
+                self._handle(item)
+            except Exception as e:
+                self._failed += 1
+                print(f"{self._name} worker error for {key}: {str(e)}")
+            finished = time.time()
+            if self._on_idle is not None:
+                # まだキューから外していないので、この間に来た同じキーの項目は後で順に動く
+                with self._cond:
+                    idle = len(self._queues[key]) == 1
+                if idle:
+                    try:
+                        self._on_idle(key)
+                    except Exception as e:
+                        print(f"{self._name} idle hook error for {key}: {str(e)}")
+            with self._cond:
+                self._queues[key].popleft()
+                if self._queues[key]:
+                    ready.put(key)
+                else:
+                    del self._queues[key]
+                self._pending -= 1
+                self._processed += 1
+                self._last_wait = started - enqueued_at
+                self._max_wait = max(self._max_wait, self._last_wait)
+                self._last_run = finished - started
+                self._cond.notify_all()
+
+    # ---- キューの深さと待ち時間 ----
+    def stats(self):
+        with self._cond:
+            return {
+                "depth": self._pending,
+                "keys": len(self._queues),
+                "limit": self._max_pending,
+                "processed": self._processed,
+                "rejected": self._rejected,
+                "failed": self._failed,
+                "wait_seconds": round(self._last_wait, 3),
+                "max_wait_seconds": round(self._max_wait, 3),
+                "run_seconds": round(self._last_run, 3),
+            }
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+
+
+# ==== 最初に使うときに作るクライアント ====
+# 起動時にクライアントを作る時間を省く。fork後のプロセスでは作り直す（接続を親プロセスと共有しない）。
+# 属性の参照はそのまま本物のクライアントに渡す。
+class LazyClient:
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._client = self._factory()
+                    self._pid = os.getpid()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self._get_client(), name)
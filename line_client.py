@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import time
+import uuid
+import random
+import threading
+from contextlib import contextmanager
+import requests
+from requests.adapters import HTTPAdapter
+from linebot import LineBotApi
+from linebot.http_client import HttpClient, RequestsHttpResponse
+from metrics import registry
+
+# ==== LINE API 呼び出しの設定 ====
+# 接続先（ベンチマークでは手元の偽サーバーに向ける）
+LINE_API_ENDPOINT = os.environ.get("LINE_API_ENDPOINT", LineBotApi.DEFAULT_API_ENDPOINT)
+LINE_API_DATA_ENDPOINT = os.environ.get("LINE_API_DATA_ENDPOINT", LineBotApi.DEFAULT_API_DATA_ENDPOINT)
+LINE_POOL_SIZE = int(os.environ.get("LINE_POOL_SIZE", "20"))
+LINE_MAX_CONCURRENCY = int(os.environ.get("LINE_MAX_CONCURRENCY", "16"))
+LINE_MAX_RETRIES = int(os.environ.get("LINE_MAX_RETRIES", "4"))
+LINE_BACKOFF_BASE = float(os.environ.get("LINE_BACKOFF_BASE", "0.5"))
+LINE_BACKOFF_MAX = float(os.environ.get("LINE_BACKOFF_MAX", "8"))
+
+# 1プロセスあたりの毎秒の呼び出し数（LINEの上限はチャネル単位なので、ワーカー数で割った値にする）
+LINE_RATE_LIMIT = float(os.environ.get("LINE_RATE_LIMIT", "500"))
+# 上限が別に決まっているエンドポイント（回/秒）
+ENDPOINT_RATE_LIMITS = {
+    "/v2/bot/message/multicast": 200,
+    "/v2/bot/message/broadcast": 60 / 3600,
+    "/v2/bot/message/narrowcast": 60 / 3600,
+}
+
+LINE_REQUEST_SECONDS = registry.histogram("nazotoki_line_request_seconds", "LINE API call latency by endpoint and status")
+LINE_RETRIES = registry.counter("nazotoki_line_retries_total", "LINE API calls retried by endpoint")
+
+_ID_PATTERN = re.compile(r"/(U[0-9a-f]{32}|C[0-9a-f]{32}|R[0-9a-f]{32}|\d{6,})(?=/|$)")
+
+# 呼び出し中のスレッドだけに付ける X-Line-Retry-Key
+_context = threading.local()
+
+
+@contextmanager
+def request_retry_key(retry_key):
+    previous = getattr(_context, "retry_key", None)
+    _context.retry_key = retry_key
+    try:
+        yield
+    finally:
+        _context.retry_key = previous
+
+
+def endpoint_name(method, url):
+    path = _ID_PATTERN.sub("/{id}", requests.utils.urlparse(url).path)
+    return f"{method} {path}"
+
+
+# ==== トークンバケット（rate 回/秒、最大 burst 回まで貯められる） ====
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# 409 でも、同じ Retry-Key の要求がすでに受け付けられていれば成功として扱う
+class AcceptedResponse(RequestsHttpResponse):
+    @property
+    def status_code(self):
+        return 200
+
+
+# ==== 接続を使い回し、流量制限と再試行を行う HTTP クライアント ====
+# 429 はどの要求でも送り直す（LINE側で処理されていない）。
+# 5xx と通信エラーは、GET と Retry-Key 付きの要求だけを送り直す（二重送信にならないもの）。
+class PooledHttpClient(HttpClient):
+    def __init__(self, timeout=HttpClient.DEFAULT_TIMEOUT):
+        super(PooledHttpClient, self).__init__(timeout)
+        self._pid = None
+        self._session = None
+        self._slots = threading.BoundedSemaphore(LINE_MAX_CONCURRENCY)
+        self._buckets = {}
+        self._metrics = {}   # {endpoint: {...}}
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def _get_session(self):
+        # fork後のプロセスではコネクションを作り直す
+        if self._pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=LINE_POOL_SIZE, max_retries=0)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._session = session
+            self._pid = os.getpid()
+        return self._session
+
+    # 上限が別に決まっているエンドポイント以外は、1つのバケットを共有する
+    def _bucket(self, path):
+        rate = ENDPOINT_RATE_LIMITS.get(path)
+        with self._lock:
+            bucket = self._buckets.get(path if rate else None)
+            if bucket is None:
+                bucket = self._buckets[path if rate else None] = TokenBucket(rate or LINE_RATE_LIMIT)
+            return bucket
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request("GET", url, headers, timeout, params=params, stream=stream)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request("POST", url, headers, timeout, data=data)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request("DELETE", url, headers, timeout, data=data)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request("PUT", url, headers, timeout, data=data)
+
+    def _request(self, method, url, headers, timeout, **kwargs):
+        headers = dict(headers or {})
+        # SDK が共有ヘッダーに残した Retry-Key は使わず、この呼び出しのものだけを付ける
+        headers.pop("X-Line-Retry-Key", None)
+        retry_key = getattr(_context, "retry_key", None)
+        if retry_key:
+            headers["X-Line-Retry-Key"] = retry_key
+        idempotent = method == "GET" or retry_key is not None
+        endpoint = endpoint_name(method, url)
+        bucket = self._bucket(requests.utils.urlparse(url).path)
+
+        for attempt in range(LINE_MAX_RETRIES + 1):
+            last = attempt == LINE_MAX_RETRIES
+            bucket.acquire()
+            started = time.time()
+            try:
+                with self._slots:
+                    self._track_in_flight(1)
+                    try:
+                        response = self._get_session().request(
+                            method, url, headers=headers, timeout=timeout or self.timeout, **kwargs
+                        )
+                    finally:
+                        self._track_in_flight(-1)
+            except requests.RequestException as e:
+                self._record(endpoint, time.time() - started, None, retried=idempotent and not last)
+                if not idempotent or last:
+                    raise
+                print(f"LINE {endpoint} failed ({str(e)}), retrying (attempt {attempt + 1})")
+                time.sleep(self._backoff(attempt, None))
+                continue
+
+            status = response.status_code
+            if status == 409 and retry_key and response.headers.get("X-Line-Accepted-Request-Id"):
+                self._record(endpoint, time.time() - started, 200)
+                return AcceptedResponse(response)
+            retryable = status == 429 or (status >= 500 and idempotent)
+            self._record(endpoint, time.time() - started, status, retried=retryable and not last)
+            if not retryable or last:
+                return RequestsHttpResponse(response)
+            delay = self._backoff(attempt, response.headers.get("Retry-After"))
+            print(f"LINE {endpoint} returned {status}, retrying in {delay:.2f}s (attempt {attempt + 1})")
+            response.close()
+            time.sleep(delay)
+
+    # 指数バックオフ（全体にジッターをかける）。Retry-After があればそれ以上待つ
+    def _backoff(self, attempt, retry_after):
+        delay = random.uniform(0, min(LINE_BACKOFF_MAX, LINE_BACKOFF_BASE * (2 ** attempt)))
+        try:
+            return max(delay, float(retry_after)) if retry_after else delay
+        except ValueError:
+            return delay
+
+    def _track_in_flight(self, delta):
+        with self._lock:
+            self._in_flight += delta
+
+    def _record(self, endpoint, elapsed, status, retried=False):
+        LINE_REQUEST_SECONDS.observe(elapsed, endpoint=endpoint, status=status or "error")
+        if retried:
+            LINE_RETRIES.inc(endpoint=endpoint)
+        with self._lock:
+            m = self._metrics.get(endpoint)
+            if m is None:
+                m = self._metrics[endpoint] = {"calls": 0, "errors": 0, "throttled": 0, "retries": 0,
+                                               "total_seconds": 0.0, "max_seconds": 0.0, "last_status": None}
+            m["calls"] += 1
+            m["total_seconds"] += elapsed
+            m["max_seconds"] = max(m["max_seconds"], elapsed)
+            m["last_status"] = status
+            if status is None or status >= 400:
+                m["errors"] += 1
+            if status == 429:
+                m["throttled"] += 1
+            if retried:
+                m["retries"] += 1
+
+    # ---- エンドポイントごとの呼び出し数・エラー・遅延 ----
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "endpoints": {
+                    endpoint: {
+                        "calls": m["calls"],
+                        "errors": m["errors"],
+                        "throttled": m["throttled"],
+                        "retries": m["retries"],
+                        "avg_seconds": round(m["total_seconds"] / m["calls"], 3),
+                        "max_seconds": round(m["max_seconds"], 3),
+                        "last_status": m["last_status"],
+                    }
+                    for endpoint, m in self._metrics.items()
+                },
+            }
+
+
+# ==== LINE Messaging API クライアント ====
+# push には毎回 Retry-Key を付け、5xx や通信エラーでも二重に届かないように送り直せるようにする。
+# SDK は retry_key をインスタンス共通のヘッダーに書き込んで残すので、ここでは渡さずスレッドごとに付ける。
+class LineClient(LineBotApi):
+    def __init__(self, channel_access_token, **kwargs):
+        kwargs.setdefault("http_client", PooledHttpClient)
+        kwargs.setdefault("endpoint", LINE_API_ENDPOINT)
+        kwargs.setdefault("data_endpoint", LINE_API_DATA_ENDPOINT)
+        super(LineClient, self).__init__(channel_access_token, **kwargs)
+
+    def push_message(self, to, messages, retry_key=None, **kwargs):
+        with request_retry_key(retry_key or str(uuid.uuid4())):
+            return super(LineClient, self).push_message(to, messages, **kwargs)
+
+    def stats(self):
+        return self.http_client.stats()
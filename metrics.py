@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+# ==== 計測の設定 ====
+# 構造化ログを出す割合（0〜1）。エラーは常に出す
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0.01"))
+# 遅延ヒストグラムの区切り（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in items)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+
+# ==== カウンター ====
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            return [f"{self.name}{_format_labels(k)} {v}" for k, v in sorted(self._values.items())]
+
+
+# ==== ヒストグラム（Prometheus と同じ累積バケット） ====
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._values = {}   # {labels: [バケットごとの件数..., 合計, 件数]}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for key, row in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, row):
+                    lines.append(f"{self.name}_bucket{_format_labels(key, [('le', repr(float(bound)))])} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {row[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {row[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {row[-1]}")
+        return lines
+
+
+# ==== ゲージ（出力のたびに fn() を呼ぶ。数値か [(ラベルのdict, 値), ...] を返す） ====
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self._fn = fn
+
+    def render(self):
+        value = self._fn()
+        if isinstance(value, list):
+            return [f"{self.name}{_format_labels(_label_key(labels))} {v}" for labels, v in value]
+        return [f"{self.name} {value}"]
+
+
+# ==== 登録簿（プロセスごと。gunicorn ではワーカーごとの値になる） ====
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help):
+        return self._register(Counter(name, help))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def gauge(self, name, help, fn):
+        return self._register(Gauge(name, help, fn))
+
+    # Prometheus のテキスト形式
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            try:
+                body = metric.render()
+            except Exception as e:
+                print(f"Failed to render metric {metric.name}: {str(e)}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(body)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# 関数の所要時間を function ラベル付きで記録する
+FUNCTION_SECONDS = registry.histogram("nazotoki_function_seconds", "Time spent in instrumented functions")
+
+
+def timed(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with FUNCTION_SECONDS.time(function=name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ==== 構造化ログ（JSON 1行、サンプリングあり） ====
+# ユーザーIDはそのまま出さず、ハッシュの先頭だけを出す
+def anonymize(user_id):
+    if not user_id:
+        return None
+    return hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:12]
+
+
+def log_event(event, always=False, **fields):
+    if not always and random.random() >= LOG_SAMPLE_RATE:
+        return
+    record = {"ts": round(time.time(), 3), "event": event}
+    record.update(fields)
+    print(json.dumps(record, ensure_ascii=False, default=str))
+
+
+# ==== boto3 クライアントの呼び出し時間（operation・status ラベル付き） ====
+def instrument_boto3(client, histogram):
+    service = client.meta.service_model.service_id.hyphenize()
+
+    def before(context, model, **kwargs):
+        context["metrics_started"] = time.perf_counter()
+        context["metrics_operation"] = model.name
+
+    def after(context, http_response=None, **kwargs):
+        started = context.pop("metrics_started", None)
+        if started is None:
+            return
+        status = http_response.status_code if http_response is not None else "error"
+        histogram.observe(time.perf_counter() - started, operation=context.get("metrics_operation"), status=status)
+
+    client.meta.events.register(f"before-call.{service}", before)
+    client.meta.events.register(f"after-call.{service}", after)
+    client.meta.events.register(f"after-call-error.{service}", after)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import threading
+from itertools import islice
+from collections import OrderedDict
+
+# ジャッジが回答を確保（claim）してから、他のジャッジに開放されるまでの秒数
+CLAIM_LEASE_SECONDS = int(os.environ.get("JUDGE_CLAIM_LEASE_SECONDS", "30"))
+
+
+# ==== 判定待ちキュー ====
+# token をキーに到着順で保持する。
+# 追加・参照・削除は O(1)、古い順の N 件は O(N)。
+class PendingQueue:
+    def __init__(self, entries=()):
+        self._items = OrderedDict()  # {token: entry}
+        self._leases = {}            # {token: (judge_id, 期限)}（"claim" の変更で全ワーカー共通）
+        self._arrival = {}           # {token: 到着番号}（取り消した削除を元の位置に戻すため）
+        self._next_arrival = 0
+        self._lock = threading.Lock()
+        for entry in entries:
+            self.add(entry)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(list(self._items.values()))
+
+    def __contains__(self, token):
+        return token in self._items
+
+    def add(self, entry):
+        token = entry["token"]
+        with self._lock:
+            if token in self._items:
+                return
+            self._items[token] = entry
+            self._arrival[token] = self._next_arrival
+            self._next_arrival += 1
+
+    def get(self, token):
+        return self._items.get(token)
+
+    def remove(self, token):
+        with self._lock:
+            entry = self._items.pop(token, None)
+            if entry is None:
+                return None
+            self._leases.pop(token, None)
+            self._arrival.pop(token, None)
+            return entry
+
+    # ---- 取り消し用: 削除した回答を元の到着順の位置に戻す ----
+    def arrival(self, token):
+        return self._arrival.get(token)
+
+    def restore(self, entry, arrival):
+        token = entry["token"]
+        with self._lock:
+            if token in self._items:
+                return
+            self._items[token] = entry
+            self._arrival[token] = arrival
+            order = self._arrival.__getitem__
+            self._items = OrderedDict(sorted(self._items.items(), key=lambda item: order(item[0])))
+
+    def oldest(self, n):
+        with self._lock:
+            return list(islice(self._items.values(), n))
+
+    # ---- 確保（同じ回答を2人のジャッジが同時に判定しないように） ----
+    # 確保は状態の変更（"claim"）としてジャーナルに書き、全ワーカーで共有する。
+    # ここでは記録と参照だけを行う（期限の判定は参照する側の時刻で行う）
+    def lease(self, token):
+        return self._leases.get(token)
+
+    def leased_by_other(self, token, judge_id, now=None):
+        now = time.time() if now is None else now
+        lease = self._leases.get(token)
+        return lease is not None and lease[0] != judge_id and lease[1] > now
+
+    # until が 0 なら開放
+    def set_lease(self, token, judge_id, until):
+        with self._lock:
+            if token not in self._items:
+                return
+            if until:
+                self._leases[token] = (judge_id, until)
+            else:
+                self._leases.pop(token, None)
+
+    # 期限内の確保 {token: [judge_id, 期限]}
+    def leases(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            return {token: [judge_id, until] for token, (judge_id, until) in self._leases.items() if until > now}
+
+    def reset_leases(self, leases):
+        with self._lock:
+            self._leases = {token: (judge_id, until) for token, (judge_id, until) in leases.items() if token in self._items}
+
+    # ---- 保存・読み込み ----
+    def to_list(self):
+        return list(self._items.values())
+
+    def reset(self, entries):
+        with self._lock:
+            self._items.clear()
+            self._leases.clear()
+            self._arrival.clear()
+        for entry in entries:
+            self.add(entry)
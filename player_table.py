@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import sys
+import json
+import struct
+import threading
+from array import array
+
+# ==== プレイヤー状態の表 ====
+# プレイヤーごとの dict の代わりに、ユーザーIDの表（ID → 行番号）と項目ごとの配列で持つ。
+# 読むときは従来と同じ形の dict {"current_q", "game_cleared", "another_count"} を新しく作って返す。
+# 書くときも dict で渡す（ジャーナルの "user" 変更はこれまで通り dict のまま）。
+# 使われていない "answers" は捨てる。それ以外の知らない項目は行ごとの dict に残す。
+DROPPED_FIELDS = ("answers",)
+_COLUMNS = ("current_q", "game_cleared", "another_count")
+
+# ---- 保存形式（リトルエンディアン） ----
+# ヘッダー: マジック・行数・ID部のバイト数・追加項目(JSON)のバイト数
+# 続いて ID の長さ(uint16 × 行数)、ID（UTF-8 を連結）、current_q(int16)、game_cleared(uint8)、
+# another_count(uint16)、追加項目 {行番号: dict} の JSON
+TABLE_MAGIC = b"PLT1"
+_HEADER = struct.Struct("<4sIII")
+
+
+def _little_endian(values):
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+class PlayerTable:
+    def __init__(self, data=None):
+        self._lock = threading.Lock()
+        self.reset(data)
+
+    def reset(self, data=None):
+        with self._lock:
+            self._index = {}              # {user_id: 行番号}
+            self._ids = []                # 行番号 → user_id
+            self._current_q = array("h")
+            self._cleared = array("B")
+            self._another = array("H")
+            self._extra = {}              # {行番号: 知らない項目の dict}
+        for user_id, state in (data or {}).items():
+            self[user_id] = state
+
+    # 別の表の中身をそのまま引き継ぐ（読み込み直したときの入れ替え用）
+    def assign(self, other):
+        with other._lock:
+            index, ids = other._index, other._ids
+            columns = (other._current_q, other._cleared, other._another, other._extra)
+        with self._lock:
+            self._index, self._ids = index, ids
+            self._current_q, self._cleared, self._another, self._extra = columns
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, user_id):
+        return user_id in self._index
+
+    def __iter__(self):
+        return iter(list(self._ids))
+
+    def __getitem__(self, user_id):
+        state = self.get(user_id)
+        if state is None:
+            raise KeyError(user_id)
+        return state
+
+    def get(self, user_id, default=None):
+        with self._lock:
+            row = self._index.get(user_id)
+            if row is None:
+                return default
+            state = {
+                "current_q": self._current_q[row],
+                "game_cleared": bool(self._cleared[row]),
+                "another_count": self._another[row],
+            }
+            extra = self._extra.get(row)
+        if extra:
+            state.update(extra)
+        return state
+
+    def __setitem__(self, user_id, state):
+        extra = {k: v for k, v in state.items() if k not in _COLUMNS and k not in DROPPED_FIELDS}
+        current_q = int(state.get("current_q", 0))
+        cleared = 1 if state.get("game_cleared", False) else 0
+        another = int(state.get("another_count", 0))
+        with self._lock:
+            row = self._index.get(user_id)
+            if row is None:
+                row = len(self._ids)
+                self._index[user_id] = row
+                self._ids.append(user_id)
+                self._current_q.append(current_q)
+                self._cleared.append(cleared)
+                self._another.append(another)
+            else:
+                self._current_q[row] = current_q
+                self._cleared[row] = cleared
+                self._another[row] = another
+            if extra:
+                self._extra[row] = extra
+            else:
+                self._extra.pop(row, None)
+
+    # 行を消す（最後の行を空いた位置に移す）。書き込めなかった変更を取り消すときに使う
+    def pop(self, user_id, default=None):
+        state = self.get(user_id)
+        with self._lock:
+            row = self._index.pop(user_id, None)
+            if row is None:
+                return default
+            last = len(self._ids) - 1
+            extra = self._extra.pop(last, None)
+            self._extra.pop(row, None)
+            if row != last:
+                moved = self._ids[last]
+                self._ids[row] = moved
+                self._index[moved] = row
+                self._current_q[row] = self._current_q[last]
+                self._cleared[row] = self._cleared[last]
+                self._another[row] = self._another[last]
+                if extra:
+                    self._extra[row] = extra
+            self._ids.pop()
+            self._current_q.pop()
+            self._cleared.pop()
+            self._another.pop()
+        return state
+
+    # ---- 保存形式との変換 ----
+    def to_bytes(self):
+        with self._lock:
+            encoded = [user_id.encode("utf-8") for user_id in self._ids]
+            lengths = array("H", (len(e) for e in encoded))
+            ids = b"".join(encoded)
+            extra = json.dumps({str(row): v for row, v in self._extra.items()}, ensure_ascii=False).encode("utf-8") \
+                if self._extra else b""
+            return b"".join([
+                _HEADER.pack(TABLE_MAGIC, len(self._ids), len(ids), len(extra)),
+                _little_endian(lengths).tobytes(),
+                ids,
+                _little_endian(self._current_q).tobytes(),
+                _little_endian(self._cleared).tobytes(),
+                _little_endian(self._another).tobytes(),
+                extra,
+            ])
+
+    @classmethod
+    def from_bytes(cls, raw):
+        raw = memoryview(raw)
+        magic, count, ids_size, extra_size = _HEADER.unpack_from(raw)
+        if magic != TABLE_MAGIC:
+            raise ValueError(f"Unknown player table format: {bytes(magic)!r}")
+        offset = _HEADER.size
+
+        def column(typecode):
+            nonlocal offset
+            values = array(typecode)
+            size = values.itemsize * count
+            values.frombytes(raw[offset:offset + size])
+            offset += size
+            return _little_endian(values)
+
+        lengths = column("H")
+        ids_raw = bytes(raw[offset:offset + ids_size])
+        offset += ids_size
+        ids = []
+        position = 0
+        for length in lengths:
+            ids.append(ids_raw[position:position + length].decode("utf-8"))
+            position += length
+        current_q = column("h")
+        cleared = column("B")
+        another = column("H")
+        extra = json.loads(bytes(raw[offset:offset + extra_size]).decode("utf-8")) if extra_size else {}
+
+        table = cls()
+        table._ids = ids
+        table._index = {user_id: row for row, user_id in enumerate(ids)}
+        table._current_q, table._cleared, table._another = current_q, cleared, another
+        table._extra = {int(row): v for row, v in extra.items()}
+        return table
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import threading
+from collections import OrderedDict
+
+# 使用済みトークンを覚えておく期間と上限
+REPLAY_TTL_SECONDS = int(os.environ.get("REPLAY_TTL_SECONDS", str(24 * 3600)))
+REPLAY_BUCKET_SECONDS = int(os.environ.get("REPLAY_BUCKET_SECONDS", "3600"))
+REPLAY_MAX_ENTRIES = int(os.environ.get("REPLAY_MAX_ENTRIES", "100000"))
+
+
+# ==== 再送防止用の期限付き集合 ====
+# 時間ごとのバケットに分けて保持し、TTL を過ぎたバケットは丸ごと捨てる。
+# 件数が上限を超えたときは、古いものから1件ずつ捨てる（登録したばかりのものは残る）。
+# 期限切れのトークンは判定待ちキューからも消えているので、重複判定にはならない。
+class ReplayGuard:
+    def __init__(self, ttl=REPLAY_TTL_SECONDS, bucket_seconds=REPLAY_BUCKET_SECONDS, max_entries=REPLAY_MAX_ENTRIES):
+        self.ttl = ttl
+        self.bucket_seconds = bucket_seconds
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()  # {バケット開始時刻: {token: None}}（バケットもトークンも古い順）
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, token):
+        with self._lock:
+            self._expire(time.time())
+            return any(token in tokens for tokens in self._buckets.values())
+
+    def add(self, token, now=None):
+        now = time.time() if now is None else now
+        start = int(now // self.bucket_seconds * self.bucket_seconds)
+        with self._lock:
+            tokens = self._buckets.get(start)
+            if tokens is None:
+                tokens = self._buckets[start] = {}
+                # 再生などで時刻が前後しても古い順を保つ
+                if len(self._buckets) > 1 and start < next(reversed(self._buckets), start):
+                    self._buckets = OrderedDict(sorted(self._buckets.items()))
+            if token not in tokens:
+                tokens[token] = None
+                self._count += 1
+            self._expire(time.time())
+
+    # 登録を取り消す（書き込めなかった変更を取り消すときに使う）
+    def discard(self, token):
+        with self._lock:
+            for tokens in self._buckets.values():
+                if token in tokens:
+                    del tokens[token]
+                    self._count -= 1
+
+    def _expire(self, now):
+        # 期限切れのバケットは丸ごと捨てる
+        while self._buckets:
+            start = next(iter(self._buckets))
+            if start + self.bucket_seconds > now - self.ttl:
+                break
+            self._count -= len(self._buckets.pop(start))
+        # 上限を超えた分は古いものから捨てる
+        while self._count > self.max_entries:
+            start, tokens = next(iter(self._buckets.items()))
+            if tokens:
+                del tokens[next(iter(tokens))]
+                self._count -= 1
+            if not tokens:
+                del self._buckets[start]
+
+    # ---- 保存形式: バケットごとにトークンを空白区切りで1文字列にまとめる ----
+    def to_dict(self):
+        with self._lock:
+            return {
+                "bucket_seconds": self.bucket_seconds,
+                "buckets": {str(start): " ".join(tokens) for start, tokens in self._buckets.items()},
+            }
+
+    def reset(self, data):
+        with self._lock:
+            self._buckets = OrderedDict()
+            self._count = 0
+        # 旧形式（トークンのリスト）は読み込み時刻で登録する
+        if isinstance(data, (list, set)):
+            now = time.time()
+            for token in data:
+                self.add(token, now)
+            return
+        span = data.get("bucket_seconds", self.bucket_seconds)
+        for start, joined in sorted(data.get("buckets", {}).items(), key=lambda kv: int(kv[0])):
+            for token in joined.split():
+                self.add(token, int(start) + span - 1)
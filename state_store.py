@@ -0,0 +1,905 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import random
+import struct
+import sqlite3
+import threading
+from collections import deque
+from botocore.exceptions import ClientError
+from pending_queue import PendingQueue
+from replay_guard import ReplayGuard
+from history_archive import HistoryArchive
+from player_table import PlayerTable
+from analytics import Analytics
+from metrics import registry
+
+# 処理済みwebhookイベントIDを覚えておく期間と上限
+EVENT_TTL_SECONDS = int(os.environ.get("EVENT_TTL_SECONDS", str(24 * 3600)))
+EVENT_MAX_ENTRIES = int(os.environ.get("EVENT_MAX_ENTRIES", "200000"))
+
+# ==== 保存キー ====
+LEGACY_STATE_KEY = "app_state.json"  # 旧形式（全状態を1ファイルに保存していた頃のキー）
+SNAPSHOT_PREFIX = "state/snapshot/"
+JOURNAL_PREFIX = "state/journal/"
+
+# ジャーナルがこの件数たまったらスナップショットに畳み込む
+COMPACT_EVERY = int(os.environ.get("STATE_COMPACT_EVERY", "200"))
+# スナップショットに畳み込んだジャーナルも、この秒数は消さずに残す（遅れているワーカーのため）
+JOURNAL_RETENTION_SECONDS = max(60, int(os.environ.get("STATE_JOURNAL_RETENTION_SECONDS", "600")))
+# 読み取り時に他ワーカーの変更を取り込む間隔
+STATE_REFRESH_INTERVAL = float(os.environ.get("STATE_REFRESH_INTERVAL", "0.5"))
+# 書き込みが競合したときの再試行回数と、再試行までの待ち時間（秒。ジッター付きの指数バックオフ）
+COMMIT_RETRIES = 8
+COMMIT_BACKOFF_BASE = 0.005
+COMMIT_BACKOFF_MAX = 0.1
+# この秒数の間の変更をまとめて1回のジャーナル書き込みにする（0 なら毎回すぐ書く）
+STATE_WRITE_WINDOW = float(os.environ.get("STATE_WRITE_WINDOW", "0.2"))
+# ローカルキャッシュの形式の版（状態の形式を変えたら上げる。違う版のキャッシュは使わない）
+STATE_CACHE_VERSION = 2
+
+
+STATE_FLUSH_SECONDS = registry.histogram("nazotoki_state_flush_seconds", "Time to write coalesced state changes to the journal")
+STATE_COALESCED = registry.counter("nazotoki_state_coalesced_total", "State changes written together with an earlier change")
+STATE_CONFLICTS = registry.counter("nazotoki_state_conflicts_total", "Journal writes that lost to another worker")
+
+
+class ConflictError(Exception):
+    pass
+
+
+def _snapshot_key(seq):
+    return f"{SNAPSHOT_PREFIX}{seq:012d}.bin"
+
+
+def _journal_key(seq):
+    return f"{JOURNAL_PREFIX}{seq:012d}.json"
+
+
+def _seq_from_key(key):
+    return int(key.rsplit("/", 1)[-1].split(".", 1)[0])
+
+
+# ==== バックエンド: S3 ====
+class S3Backend:
+    def __init__(self, client, bucket):
+        self.client = client
+        self.bucket = bucket
+
+    def get(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return response['Body'].read()
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType='application/json')
+
+    # 条件付きPUT（If-None-Match: *）。すでに存在すれば False
+    def put_if_absent(self, key, data):
+        try:
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType='application/json', IfNoneMatch='*')
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409'):
+                return False
+            raise
+        return True
+
+    def list(self, prefix, start_after=None):
+        keys = []
+        kwargs = {"Bucket": self.bucket, "Prefix": prefix}
+        if start_after:
+            kwargs["StartAfter"] = start_after
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(**kwargs):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        return sorted(keys)
+
+    def delete(self, keys):
+        keys = list(keys)
+        for i in range(0, len(keys), 1000):
+            self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": k} for k in keys[i:i + 1000]], "Quiet": True}
+            )
+
+
+# ==== バックエンド: ローカルディレクトリ（テスト・開発用） ====
+class LocalDirBackend:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def put_if_absent(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        try:
+            # link は宛先が存在すると失敗するので、作成と中身の書き込みが原子的になる
+            os.link(tmp_path, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_path)
+
+    def list(self, prefix, start_after=None):
+        keys = []
+        base = self._path(prefix.rsplit("/", 1)[0]) if "/" in prefix else self.root
+        for dirpath, _, filenames in os.walk(base):
+            for name in filenames:
+                if name.endswith(".tmp"):
+                    continue
+                rel = os.path.relpath(os.path.join(dirpath, name), self.root)
+                key = rel.replace(os.sep, "/")
+                if key.startswith(prefix) and (start_after is None or key > start_after):
+                    keys.append(key)
+        return sorted(keys)
+
+    def delete(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+
+# ==== バックエンド: SQLiteファイル（同じマシンの複数ワーカーで共有する場合） ====
+class SQLiteBackend:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, data BLOB NOT NULL)")
+
+    def _conn(self):
+        # 接続はスレッドごと・プロセスごとに作る（fork後に使い回さない）
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute("SELECT data FROM objects WHERE key = ?", (key,)).fetchone()
+        return bytes(row[0]) if row else None
+
+    def put(self, key, data):
+        self._conn().execute("INSERT OR REPLACE INTO objects (key, data) VALUES (?, ?)", (key, data))
+
+    def put_if_absent(self, key, data):
+        try:
+            self._conn().execute("INSERT INTO objects (key, data) VALUES (?, ?)", (key, data))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def list(self, prefix, start_after=None):
+        rows = self._conn().execute(
+            "SELECT key FROM objects WHERE key >= ? AND key < ? ORDER BY key",
+            (prefix, prefix + "\uffff")
+        ).fetchall()
+        return [r[0] for r in rows if start_after is None or r[0] > start_after]
+
+    def delete(self, keys):
+        self._conn().executemany("DELETE FROM objects WHERE key = ?", [(k,) for k in keys])
+
+
+# ==== ローカルのスナップショットキャッシュ（起動時にバックエンドを待たないため） ====
+# 最後に確認した状態を1ファイルに書いておき、次の起動ではまずこれを読む。
+# 版と保存先（source）が一致しないもの・壊れているものは使わない。
+class SnapshotCache:
+    def __init__(self, path, source):
+        self.path = path
+        self.source = source
+
+    def read(self, backend=None):
+        try:
+            with open(self.path, "rb") as f:
+                data = decode_snapshot(f.read(), backend)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError, struct.error) as e:
+            print(f"Ignoring unreadable state cache {self.path}: {str(e)}")
+            return None
+        if data.get("version") != STATE_CACHE_VERSION or data.get("source") != self.source:
+            print(f"Ignoring state cache {self.path} (version or source mismatch).")
+            return None
+        return data
+
+    def write(self, meta, state):
+        self.save(self.encode(meta, state))
+
+    # 状態のロック中に encode し、ファイルへの書き込みはロックの外で行えるように分けてある
+    def encode(self, meta, state):
+        return encode_snapshot(dict(meta, version=STATE_CACHE_VERSION, source=self.source), state)
+
+    def save(self, raw):
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(raw)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Failed to write state cache {self.path}: {str(e)}")
+
+
+# ==== 状態の初期値と変更の適用 ====
+def empty_state(backend=None):
+    return {
+        "user_states": PlayerTable(),  # user_id -> {"current_q": int, "game_cleared": bool, "another_count": int}
+        "pending_judges": PendingQueue(),  # token -> {"user_id": str, "qnum": int, "img_url": str, "token": str}
+        "judged_history": HistoryArchive(backend),  # 古い分はセグメントとして保存し、末尾だけメモリに持つ
+        "used_tokens": ReplayGuard(),  # 使用済みトークン（期限付き）
+        "seen_events": ReplayGuard(ttl=EVENT_TTL_SECONDS, max_entries=EVENT_MAX_ENTRIES),  # 処理済みのwebhookEventId
+        "analytics": Analytics(),  # 章ごとの人数・正解率・判定待ち時間などの集計
+        "event_owners": {},  # user_id -> [担当ワーカー, 期限]（そのユーザーのイベントを処理中のワーカー）
+    }
+
+
+def state_from_dict(data, backend=None):
+    state = empty_state(backend)
+    state["user_states"].reset(data.get("user_states", {}))
+    state["pending_judges"].reset(data.get("pending_judges", []))
+    state["pending_judges"].reset_leases(data.get("pending_claims", {}))
+    state["judged_history"].reset(data.get("judged_history", []))
+    state["used_tokens"].reset(data.get("used_tokens", []))
+    state["seen_events"].reset(data.get("seen_events", {}))
+    state["event_owners"].update(data.get("event_owners", {}))
+    # 集計のない以前の状態は、プレイヤーの状態から作れる分だけ作る
+    if "analytics" in data:
+        state["analytics"].reset(data["analytics"])
+    else:
+        state["analytics"].seed(state["user_states"])
+    return state
+
+
+# ==== スナップショットの保存形式 ====
+# マジック・JSON部のバイト数・プレイヤー表のバイト数（<4sII）、JSON部、プレイヤー表（PlayerTable.to_bytes）。
+# JSON部は {"seq": int, "ts": float, ..., "state": プレイヤー以外の状態}。
+# 以前の全体がJSONのスナップショットもそのまま読める（次の圧縮でこの形式に書き直す）。
+SNAPSHOT_MAGIC = b"NZS1"
+_SNAPSHOT_HEADER = struct.Struct("<4sII")
+
+
+def encode_snapshot(meta, state):
+    head = json.dumps(dict(meta, state={
+        "pending_judges": state["pending_judges"].to_list(),
+        "pending_claims": state["pending_judges"].leases(),
+        "judged_history": state["judged_history"].to_dict(),
+        "used_tokens": state["used_tokens"].to_dict(),
+        "seen_events": state["seen_events"].to_dict(),
+        "analytics": state["analytics"].to_dict(),
+        "event_owners": state["event_owners"],
+    }), ensure_ascii=False).encode('utf-8')
+    players = state["user_states"].to_bytes()
+    return b"".join([_SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(head), len(players)), head, players])
+
+
+# 戻り値の "state" は状態そのもの（empty_state と同じ形）
+def decode_snapshot(raw, backend=None):
+    if raw[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        data = json.loads(raw.decode('utf-8'))
+        data["state"] = state_from_dict(data["state"], backend)
+        data["format"] = "json"
+        return data
+    _, head_size, players_size = _SNAPSHOT_HEADER.unpack_from(raw)
+    offset = _SNAPSHOT_HEADER.size
+    data = json.loads(raw[offset:offset + head_size].decode('utf-8'))
+    state = state_from_dict(data["state"], backend)
+    offset += head_size
+    state["user_states"].assign(PlayerTable.from_bytes(raw[offset:offset + players_size]))
+    if "analytics" not in data["state"]:
+        state["analytics"].seed(state["user_states"])
+    data["state"] = state
+    data["format"] = "binary"
+    return data
+
+
+# ジャーナルに記録される変更（mutation）の種類:
+#   {"op": "user", "user_id": str, "state": dict}          ユーザー1人分の状態を置き換え
+#   {"op": "pending_add", "entry": dict}                    判定待ちに追加
+#   {"op": "judged", "token": str, "entry": dict}           判定済みにして履歴へ移動
+#   {"op": "event", "id": str, "ts": float}                 webhookイベントを処理済みにする
+#   {"op": "claim", "token": str, "judge_id": str, "until": float}  ジャッジが判定待ちを確保（until=0 で開放）
+#   {"op": "stat", "name": str, "qnum": int}                集計だけを数える（回答・ヒント）
+#   {"op": "owner", "user_id": str, "worker": str, "until": float}  ユーザーのイベントの担当ワーカー（until=0 で開放）
+# 集計は変更を適用する直前の値と比べて数える
+def apply_mutation(state, mutation):
+    op = mutation.get("op")
+    analytics = state["analytics"]
+    if op == "user":
+        user_id = mutation["user_id"]
+        analytics.player_changed(state["user_states"].get(user_id), mutation["state"])
+        state["user_states"][user_id] = mutation["state"]
+    elif op == "pending_add":
+        analytics.record("answer", mutation["entry"]["qnum"])
+        state["pending_judges"].add(mutation["entry"])
+    elif op == "judged":
+        token = mutation["token"]
+        analytics.answer_judged(state["pending_judges"].get(token), mutation["entry"])
+        state["pending_judges"].remove(token)
+        state["judged_history"].append(mutation["entry"])
+        state["used_tokens"].add(token, mutation["entry"].get("judged_at"))
+    elif op == "event":
+        state["seen_events"].add(mutation["id"], mutation.get("ts"))
+    elif op == "claim":
+        state["pending_judges"].set_lease(mutation["token"], mutation["judge_id"], mutation["until"])
+    elif op == "owner":
+        if mutation["until"]:
+            state["event_owners"][mutation["user_id"]] = [mutation["worker"], mutation["until"]]
+        else:
+            state["event_owners"].pop(mutation["user_id"], None)
+    elif op == "stat":
+        analytics.record(mutation["name"], mutation["qnum"])
+    else:
+        print(f"Unknown state mutation skipped: {op}")
+
+
+# ==== まだ書いていない変更の取り消し ====
+# apply_mutation の直前に呼び、その変更を取り消す関数を返す（集計は StateStore が丸ごと戻す）。
+# 後から適用した変更から順に取り消すこと。
+def undo_mutation(state, mutation):
+    op = mutation.get("op")
+    users, pending = state["user_states"], state["pending_judges"]
+    if op == "user":
+        user_id = mutation["user_id"]
+        before = users.get(user_id)
+
+        def undo():
+            if before is None:
+                users.pop(user_id)
+            else:
+                users[user_id] = before
+    elif op == "pending_add":
+        token = mutation["entry"]["token"]
+        existed = token in pending
+
+        def undo():
+            if not existed:
+                pending.remove(token)
+    elif op == "judged":
+        token = mutation["token"]
+        removed = pending.get(token)
+        arrival = pending.arrival(token)
+        lease = pending.lease(token)
+        used = token in state["used_tokens"]
+
+        def undo():
+            state["judged_history"].pop()
+            if not used:
+                state["used_tokens"].discard(token)
+            if removed is not None:
+                pending.restore(removed, arrival)
+                if lease is not None:
+                    pending.set_lease(token, *lease)
+    elif op == "event":
+        event_id = mutation["id"]
+        seen = event_id in state["seen_events"]
+
+        def undo():
+            if not seen:
+                state["seen_events"].discard(event_id)
+    elif op == "claim":
+        token = mutation["token"]
+        lease = pending.lease(token)
+
+        def undo():
+            pending.set_lease(token, *(lease or (None, 0)))
+    elif op == "owner":
+        owners, user_id = state["event_owners"], mutation["user_id"]
+        before = owners.get(user_id)
+
+        def undo():
+            if before is None:
+                owners.pop(user_id, None)
+            else:
+                owners[user_id] = before
+    else:
+        def undo():
+            pass
+    return undo
+
+
+# ==== 状態ストア（スナップショット + 追記型ジャーナル） ====
+# 複数ワーカー・複数ノードから同じバックエンドを共有できる。
+# ジャーナルは連番のキーに「存在しなければ作成」で書くので、同じ番号を取れるのは1人だけ。
+# 取れなかった側は他の変更を読み込んでから変更を作り直す（楽観的排他制御）。
+# ロックは _sync_lock → lock の順に取る（逆順に取らない）。
+class StateStore:
+    def __init__(self, backend, compact_every=COMPACT_EVERY, write_window=STATE_WRITE_WINDOW, cache=None):
+        self.backend = backend
+        self.cache = cache      # SnapshotCache（なければ None）
+        self.compact_every = compact_every
+        self.write_window = write_window
+        self.state = empty_state(backend)
+        self.seq = 0            # 最後に適用したジャーナル番号
+        self.snapshot_seq = 0   # 最新スナップショットに含まれるジャーナル番号
+        self.snapshot_ts = 0.0  # そのスナップショットを書いた時刻
+        self.synced_at = 0.0    # バックエンドの最新と一致していることを最後に確認した時刻
+        self.lock = threading.RLock()  # メモリ上の状態のロック（バックエンドとのやりとりの間は持たない）
+        self._sync_lock = threading.RLock()  # バックエンドとのやりとり（書き込み・取り込み・読み直し）は1つずつ
+        self.listeners = []     # 変更が適用されるたびに listener(mutation, seq) で呼ばれる
+        self._journal_ts = deque()  # [(seq, 書き込み時刻)]（古いジャーナルの削除判定用）
+        self._dirty = []        # 適用済みでまだ書いていない変更 [[build, mutations, 取り消し関数のリスト], ...]
+        self._dirty_since = 0.0
+        self._legacy_snapshot = False  # 最新のスナップショットが以前のJSON形式
+        self._compact_due = False      # 区切りの番号を書いたが、まだ圧縮していない
+        self._wake = None
+        self._flusher_pid = None
+        self._flushes = 0
+        self._coalesced = 0
+        self._flush_failures = 0
+        self._last_flush = 0.0
+        self._max_flush = 0.0
+        self._last_delay = 0.0
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def _notify(self, mutation, seq):
+        for listener in self.listeners:
+            try:
+                listener(mutation, seq)
+            except Exception as e:
+                print(f"State listener failed: {str(e)}")
+
+    def _assign_state(self, new_state):
+        # app側が各コンテナを直接参照しているので、中身だけを入れ替える
+        self.state["user_states"].assign(new_state["user_states"])
+        self.state["pending_judges"].reset(new_state["pending_judges"].to_list())
+        self.state["pending_judges"].reset_leases(new_state["pending_judges"].leases())
+        self.state["judged_history"].reset(new_state["judged_history"].to_dict())
+        self.state["used_tokens"].reset(new_state["used_tokens"].to_dict())
+        self.state["seen_events"].reset(new_state["seen_events"].to_dict())
+        self.state["analytics"].reset(new_state["analytics"].to_dict())
+        self.state["event_owners"].clear()
+        self.state["event_owners"].update(new_state["event_owners"])
+
+    def _read_snapshot(self):
+        # 読んでいる間に他のワーカーが古いスナップショットを消すことがあるので、取り直す
+        for _ in range(3):
+            snapshot_keys = self.backend.list(SNAPSHOT_PREFIX)
+            if not snapshot_keys:
+                return None
+            raw = self.backend.get(snapshot_keys[-1])
+            if raw is not None:
+                return decode_snapshot(raw, self.backend)
+        raise ConflictError("Snapshot disappeared while loading")
+
+    # ---- スナップショットとその後のジャーナルから読み直す ----
+    # 読み込み（バックエンドとのやりとり）はロックの外で行い、最後に状態を入れ替える。
+    # まだ書いていない変更は、読み直した状態の上で build() から作り直す。
+    def load(self):
+        with self._sync_lock:
+            state = empty_state(self.backend)
+            seq = 0
+            snapshot_ts = 0.0
+            # 以前のJSON形式から読んだら、次の書き込みでこの形式のスナップショットに書き直す
+            legacy_format = False
+            data = self._read_snapshot()
+            if data is not None:
+                state = data["state"]
+                seq = data["seq"]
+                snapshot_ts = data["ts"]
+                legacy_format = data["format"] == "json"
+            else:
+                legacy = self.backend.get(LEGACY_STATE_KEY)
+                if legacy is not None:
+                    state = state_from_dict(json.loads(legacy.decode('utf-8')), self.backend)
+                    print(f"Migrated legacy state from {LEGACY_STATE_KEY}.")
+                    legacy_format = True
+            snapshot_seq = seq
+
+            replayed = 0
+            journal_ts = deque()
+            started = time.time()
+            # 今の番号より後のジャーナル（購読者には差分として通知する）
+            newer = []
+            for key in self.backend.list(JOURNAL_PREFIX, start_after=_journal_key(seq)):
+                raw = self.backend.get(key)
+                if raw is None:
+                    continue
+                entry = json.loads(raw.decode('utf-8'))
+                for mutation in entry["mutations"]:
+                    apply_mutation(state, mutation)
+                seq = entry["seq"]
+                journal_ts.append((seq, entry["ts"]))
+                replayed += 1
+                if seq > self.seq:
+                    newer.append(entry)
+
+            with self.lock:
+                dirty = self._dirty
+                # 読み込んだ状態が今の番号から続いていれば、購読者には間の変更だけを通知する。
+                # スナップショットが今の番号より新しい（間が飛んでいる）ときだけリセットを通知する
+                continuous = snapshot_seq <= self.seq <= seq and \
+                    [entry["seq"] for entry in newer] == list(range(self.seq + 1, seq + 1))
+                self._assign_state(state)
+                if continuous:
+                    for entry in newer:
+                        for mutation in entry["mutations"]:
+                            self._notify(mutation, entry["seq"])
+                else:
+                    self._notify({"op": "reset"}, seq)
+                self.seq = seq
+                self.snapshot_seq = snapshot_seq
+                self.snapshot_ts = snapshot_ts
+                self._journal_ts = journal_ts
+                self._legacy_snapshot = legacy_format
+                self.synced_at = started
+                self._restage(dirty)
+            print(f"State loaded (snapshot seq={snapshot_seq}, replayed {replayed} journal entries).")
+
+    # ---- ローカルキャッシュから読む（バックエンドには触れない）。使えなければ False ----
+    # 読んだ状態は古いかもしれないので、revalidate() で最新に追いつかせること
+    def load_cached(self):
+        if self.cache is None:
+            return False
+        data = self.cache.read(self.backend)
+        if data is None:
+            return False
+        with self._sync_lock, self.lock:
+            try:
+                state = data["state"]
+                seq, snapshot_seq, snapshot_ts = data["seq"], data["snapshot_seq"], data["snapshot_ts"]
+            except KeyError as e:
+                print(f"Ignoring broken state cache: missing {str(e)}")
+                return False
+            self._assign_state(state)
+            self.seq = seq
+            self.snapshot_seq = snapshot_seq
+            self.snapshot_ts = snapshot_ts
+            self._journal_ts = deque()
+            self.synced_at = 0.0
+            self._notify({"op": "reset"}, seq)
+        print(f"State loaded from local cache (seq={seq}).")
+        return True
+
+    # ---- キャッシュから読んだ状態を、バックエンドの最新に追いつかせる ----
+    # キャッシュの番号のジャーナルかスナップショットがまだあれば、その後の差分だけを取り込む。
+    # なければ（圧縮で消えた・保存先が作り直された）スナップショットから読み直す。
+    def revalidate(self):
+        with self._sync_lock:
+            if self.seq:
+                journal = self.backend.list(JOURNAL_PREFIX, start_after=_journal_key(self.seq - 1))
+                known = journal[:1] == [_journal_key(self.seq)] or \
+                    any(_seq_from_key(k) == self.seq for k in self.backend.list(SNAPSHOT_PREFIX))
+                if not known:
+                    self.load()
+                    return -1
+            self.synced_at = time.time()
+            return self.refresh()
+
+    # ---- 書き込み済みの状態をローカルキャッシュに残す ----
+    # 複数のワーカーが書くと最後の1つが残るので、他のワーカーの変更も取り込んでから書く
+    def save_cache(self):
+        if self.cache is None:
+            return False
+        with self._sync_lock:
+            self.flush()
+            self.refresh()
+            with self.lock:
+                # まだ書いていない変更を含めると、番号と中身が食い違う
+                if self._dirty:
+                    return False
+                raw = self.cache.encode({"seq": self.seq, "snapshot_seq": self.snapshot_seq,
+                                         "snapshot_ts": self.snapshot_ts, "ts": time.time()}, self.state)
+            self.cache.save(raw)
+        return True
+
+    def _apply_entry(self, entry):
+        for mutation in entry["mutations"]:
+            apply_mutation(self.state, mutation)
+            self._notify(mutation, entry["seq"])
+        self.seq = entry["seq"]
+        self._journal_ts.append((entry["seq"], entry["ts"]))
+
+    # ---- seq より後のジャーナルを番号順に読む（ロックの外で呼ぶ）。間が抜けていれば None ----
+    def _fetch_entries(self, seq):
+        entries = []
+        for key in self.backend.list(JOURNAL_PREFIX, start_after=_journal_key(seq)):
+            raw = self.backend.get(key)
+            entry = json.loads(raw.decode('utf-8')) if raw is not None else None
+            if entry is None or entry["seq"] != seq + len(entries) + 1:
+                return None
+            entries.append(entry)
+        return entries
+
+    # ---- 他のワーカーが書いたジャーナルを取り込む（_sync_lock を持って呼ぶ） ----
+    # まだ書いていない変更はいったん取り消し、取り込んだ後に build() で作り直す。
+    # 間のジャーナルが圧縮で消えている可能性があれば、スナップショットから読み直す（戻り値 -1）。
+    def _catch_up(self):
+        started = time.time()
+        entries = self._fetch_entries(self.seq)
+        if entries is None or (not entries and started - self.synced_at > JOURNAL_RETENTION_SECONDS / 2):
+            self.load()
+            return -1
+        with self.lock:
+            if entries:
+                dirty = self._dirty
+                self._rollback()
+                for entry in entries:
+                    self._apply_entry(entry)
+                self._restage(dirty)
+            self.synced_at = started
+        return len(entries)
+
+    # ---- 他のワーカーが書いたジャーナルを取り込む（max_age 秒以内に確認済みなら何もしない） ----
+    # まだ書いていない変更は書き出さず、取り込んだ変更の後ろに作り直す（書くのは write_window ごと）
+    def refresh(self, max_age=0):
+        if time.time() - self.synced_at < max_age:
+            return 0
+        with self._sync_lock:
+            return self._catch_up()
+
+    # ---- 変更をまとめて書く（write-behind） ----
+    # transact した変更はすぐにメモリ上の状態へ適用し、write_window 秒の間の分をまとめて
+    # 1つのジャーナルに書く。変更ごとに取り消し方（undo_mutation）を覚えておき、
+    # 競合したら取り消して他のワーカーの分だけを取り込み、build() を順にやり直す。
+    def _stage(self, build, mutations):
+        if not self._dirty:
+            self._dirty_since = time.time()
+        entry = [build, mutations, self._apply_staged(mutations)]
+        self._dirty.append(entry)
+        return entry
+
+    def _apply_staged(self, mutations):
+        # 集計は変更ごとに戻すより丸ごと戻すほうが簡単なので、適用前の値を取っておく
+        analytics = self.state["analytics"]
+        before = analytics.to_dict()
+        undo = [lambda: analytics.reset(before)]
+        for mutation in mutations:
+            undo.append(undo_mutation(self.state, mutation))
+            apply_mutation(self.state, mutation)
+        return undo
+
+    def _rollback(self):
+        for entry in reversed(self._dirty):
+            for undo in reversed(entry[2]):
+                undo()
+        self._dirty = []
+
+    # まだ書いていない変更を一時的に外し、ジャーナルに書かれた分だけの状態で read(state) を呼ぶ。
+    # 外した変更は作り直さずにそのまま適用し直す
+    def read_committed(self, read):
+        with self.lock:
+            dirty = self._dirty
+            self._rollback()
+            try:
+                return read(self.state)
+            finally:
+                for entry in dirty:
+                    entry[2] = self._apply_staged(entry[1])
+                self._dirty = dirty
+
+    # 書けなかった変更を取り消して捨てる。まだ書かれていなければ True
+    # （他のスレッドの flush がすでに書いた・作り直しで何もしなくなったときは False）
+    def _discard(self, entry):
+        with self._sync_lock, self.lock:
+            if not any(staged is entry for staged in self._dirty):
+                return False
+            dirty = [staged for staged in self._dirty if staged is not entry]
+            self._rollback()
+            self._restage(dirty)
+            return True
+
+    # 取り消した変更を、今の状態から build() で作り直す（何もしなくなったものは捨てる）
+    def _restage(self, dirty):
+        self._dirty = []
+        for entry in dirty:
+            entry[1] = entry[0]()
+            if entry[1]:
+                entry[2] = self._apply_staged(entry[1])
+                self._dirty.append(entry)
+
+    def _write_entry(self, seq, mutations):
+        entry = {"seq": seq, "ts": time.time(), "mutations": mutations}
+        if not self.backend.put_if_absent(_journal_key(seq), json.dumps(entry, ensure_ascii=False).encode('utf-8')):
+            raise ConflictError(f"Journal seq {seq} was written by another worker")
+        return entry
+
+    # 書き込みはロックの外で行うので、その間も transact は新しい変更を積める。
+    # 競合したら少し待って（ジッター付きの指数バックオフ）から差分を取り込み、書き直す。
+    def flush(self, retries=COMMIT_RETRIES):
+        with self._sync_lock:
+            started = time.time()
+            conflicts = 0
+            while True:
+                if time.time() - self.synced_at > JOURNAL_RETENTION_SECONDS / 2:
+                    # 間のジャーナルが消えているかもしれないので、取り込んでから書く
+                    self._catch_up()
+                with self.lock:
+                    if not self._dirty:
+                        return
+                    batch = len(self._dirty)
+                    mutations = [m for entry in self._dirty for m in entry[1]]
+                    seq = self.seq + 1
+                try:
+                    entry = self._write_entry(seq, mutations)
+                except ConflictError as e:
+                    conflicts += 1
+                    STATE_CONFLICTS.inc()
+                    print(f"State write conflict (attempt {conflicts}): {str(e)}")
+                    if conflicts >= retries:
+                        self._flush_failures += 1
+                        raise ConflictError(f"Gave up after {retries} conflicting writes")
+                    time.sleep(random.uniform(0, min(COMMIT_BACKOFF_MAX, COMMIT_BACKOFF_BASE * 2 ** conflicts)))
+                    self._catch_up()
+                    continue
+                except Exception:
+                    self._flush_failures += 1
+                    raise
+                with self.lock:
+                    # 状態には適用済みなので、番号を進めて通知だけ行う
+                    for mutation in mutations:
+                        self._notify(mutation, seq)
+                    self.seq = seq
+                    self._journal_ts.append((seq, entry["ts"]))
+                    self.synced_at = entry["ts"]
+                    self._dirty = self._dirty[batch:]
+                    # この書き込みで区切りに達した判定履歴のセグメント（まだ積んである判定の分は除く）
+                    history = self.state["judged_history"]
+                    committed = len(history) - sum(1 for staged in self._dirty for m in staged[1] if m["op"] == "judged")
+                    segments = history.unwritten(committed - sum(1 for m in mutations if m["op"] == "judged"), committed)
+                    finished = time.time()
+                    self._flushes += 1
+                    self._coalesced += batch - 1
+                    self._last_flush = finished - started
+                    self._max_flush = max(self._max_flush, self._last_flush)
+                    self._last_delay = finished - self._dirty_since
+                    # 書いている間に積まれた変更は次の書き込みに回す
+                    self._dirty_since = started
+                    # 圧縮は区切りの番号を書いたワーカーだけが行う（書いていない変更がなくなってから）
+                    if seq % self.compact_every == 0:
+                        self._compact_due = True
+                STATE_FLUSH_SECONDS.observe(self._last_flush)
+                STATE_COALESCED.inc(batch - 1)
+                self._store_history(segments)
+                if self._compact_due or self._legacy_snapshot:
+                    try:
+                        self.compact()
+                    except Exception as e:
+                        # 圧縮に失敗してもジャーナルは残っているので状態は失われない
+                        print(f"State compaction failed: {str(e)}")
+                return
+
+    # セグメントの保存に失敗しても判定履歴はジャーナルにあり、次の圧縮の前に保存し直す
+    def _store_history(self, segments):
+        if not segments:
+            return
+        try:
+            self.state["judged_history"].store(segments)
+        except Exception as e:
+            print(f"Failed to store judged history segments: {str(e)}")
+
+    def _schedule_flush(self):
+        # fork後のプロセスではスレッドを作り直す
+        if self._flusher_pid != os.getpid():
+            self._flusher_pid = os.getpid()
+            self._wake = threading.Event()
+            threading.Thread(target=self._flush_loop, name="state-flush", daemon=True).start()
+        self._wake.set()
+
+    def _flush_loop(self):
+        wake = self._wake
+        while True:
+            wake.wait()
+            time.sleep(self.write_window)
+            wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # 変更はメモリに残っているので、次の周期で書き直す
+                print(f"Deferred state write failed: {str(e)}")
+                wake.set()
+
+    # ---- build() で現在の状態から変更を作り、競合したら読み直して作り直す ----
+    # build は状態を直接書き換えず、変更のリストか None（何もしない）を返すこと。
+    # sync=False なら書き込みを待たずに返る（write_window 秒以内にまとめて書かれる）。
+    # sync=True なら書き終わるまで待ち、競合でやり直した後の変更（None もありうる）を返す。
+    # 書けずに例外を返すときは変更を取り消してあるので、呼び出し元はやり直してよい
+    # （裏で書き直すと、失敗と思った呼び出し元の後始末、たとえば配信が行われないまま変更だけが残る）。
+    # 書き込みは self.lock の外で行うので、self.lock を持ったまま呼ばないこと。
+    def transact(self, build, retries=COMMIT_RETRIES, sync=False):
+        with self.lock:
+            mutations = build()
+            if not mutations:
+                return None
+            entry = self._stage(build, mutations)
+        if sync or self.write_window <= 0:
+            try:
+                self.flush(retries)
+            except Exception:
+                discarded = self._discard(entry)
+                if self._dirty:
+                    # 一緒に積まれていた他の変更は裏で書き直す
+                    self._schedule_flush()
+                if discarded:
+                    raise
+                # 待っている間に他のスレッドの flush が書いた（または作り直しで何もしなくなった）
+            return entry[1]
+        self._schedule_flush()
+        return mutations
+
+    # ---- まとめ書きの状況 ----
+    def write_stats(self):
+        with self.lock:
+            return {
+                "window_seconds": self.write_window,
+                "dirty": len(self._dirty),
+                "flushes": self._flushes,
+                "coalesced": self._coalesced,
+                "failed": self._flush_failures,
+                "flush_seconds": round(self._last_flush, 3),
+                "max_flush_seconds": round(self._max_flush, 3),
+                "delay_seconds": round(self._last_delay, 3),
+            }
+
+    # ---- スナップショットに畳み込む ----
+    # 書いていない変更があるとスナップショットに混ざるので、そのときは次の書き込みの後に回す
+    def compact(self):
+        with self._sync_lock:
+            with self.lock:
+                if self._dirty:
+                    self._compact_due = True
+                    return False
+                seq = self.seq
+                data = {"seq": seq, "ts": time.time()}
+                # スナップショットが指すセグメントは先に保存しておく（書き込みの後で保存できなかった分など）
+                segments = self.state["judged_history"].unwritten()
+                raw = encode_snapshot(data, self.state)
+                cache_raw = self.cache.encode(dict(data, snapshot_seq=seq, snapshot_ts=data["ts"]), self.state) \
+                    if self.cache is not None else None
+            if segments:
+                self.state["judged_history"].store(segments)
+            self.backend.put(_snapshot_key(seq), raw)
+            # 保持期間を過ぎたジャーナルだけを消す（遅れているワーカーが番号を再利用しないように）
+            cutoff = time.time() - JOURNAL_RETENTION_SECONDS
+            removable = 0
+            if self.snapshot_ts < cutoff:
+                # 前回のスナップショットより前の分は、スナップショットごと保持期間を過ぎている
+                removable = self.snapshot_seq
+            while self._journal_ts and self._journal_ts[0][1] < cutoff and self._journal_ts[0][0] <= seq:
+                removable = max(removable, self._journal_ts.popleft()[0])
+            old_snapshots = [k for k in self.backend.list(SNAPSHOT_PREFIX) if _seq_from_key(k) < seq]
+            old_journal = [k for k in self.backend.list(JOURNAL_PREFIX) if _seq_from_key(k) <= removable]
+            self.backend.delete(old_snapshots + old_journal)
+            with self.lock:
+                self.snapshot_seq = seq
+                self.snapshot_ts = data["ts"]
+                self._legacy_snapshot = False
+                self._compact_due = False
+            if cache_raw is not None:
+                self.cache.save(cache_raw)
+            print(f"State compacted into snapshot seq={seq} ({len(old_journal)} journal entries removed).")
+            return True
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import unittest
+from replay_guard import ReplayGuard
+
+
+class ReplayGuardTest(unittest.TestCase):
+    def test_max_entries_keeps_newest(self):
+        guard = ReplayGuard(ttl=3600, bucket_seconds=60, max_entries=3)
+        for n in range(5):
+            guard.add(f"t{n}")
+        self.assertEqual(len(guard), 3)
+        self.assertNotIn("t0", guard)
+        self.assertNotIn("t1", guard)
+        for n in range(2, 5):
+            self.assertIn(f"t{n}", guard)
+
+    def test_max_entries_evicts_older_buckets_first(self):
+        guard = ReplayGuard(ttl=10 ** 9, bucket_seconds=60, max_entries=2)
+        guard.add("old", now=0)
+        guard.add("new1")
+        guard.add("new2")
+        self.assertEqual(len(guard), 2)
+        self.assertNotIn("old", guard)
+        self.assertIn("new1", guard)
+        self.assertIn("new2", guard)
+
+    def test_ttl_expires_whole_buckets(self):
+        guard = ReplayGuard(ttl=60, bucket_seconds=60)
+        guard.add("stale", now=0)
+        guard.add("fresh")
+        self.assertNotIn("stale", guard)
+        self.assertIn("fresh", guard)
+        self.assertEqual(len(guard), 1)
+
+    def test_round_trip_keeps_bound(self):
+        guard = ReplayGuard(ttl=3600, bucket_seconds=60, max_entries=3)
+        for n in range(5):
+            guard.add(f"t{n}")
+        restored = ReplayGuard(ttl=3600, bucket_seconds=60, max_entries=3)
+        restored.reset(guard.to_dict())
+        self.assertEqual(sorted(restored.to_dict()["buckets"].values()), sorted(guard.to_dict()["buckets"].values()))
+        self.assertIn("t4", restored)
+
+
+if __name__ == "__main__":
+    unittest.main()